@@ -1,30 +1,69 @@
+import json
 import logging
-import subprocess
-import tempfile
+from pathlib import Path
 
-import yaml
-from ansible.inventory.manager import InventoryManager
-from ansible.parsing.dataloader import DataLoader
-
-from docker_deploy.ansible_deploy.task import Task
-from docker_deploy.backend_map_lib import Instance
+from docker_deploy import yaml_lib
+from docker_deploy.ansible_deploy.events import EventReport
+from docker_deploy.ansible_deploy.executor import get_executor
+from docker_deploy.ansible_deploy.task import Task, Block
+from docker_deploy.backend_map_lib import BackendMap
+from docker_deploy.config_lib import Execution
 
 
 class Play(dict):
 
-    def __init__(self, name: str, tasks: list[Task], hosts: list[str]):
+    def __init__(self, name: str, tasks: list[Task], hosts: list[str],
+                 gather_facts: bool = False, instance_id: str | None = None):
         super().__init__()
         self['name'] = name
         self['hosts'] = hosts
         self['tasks'] = tasks
+        self['instance_id'] = instance_id
+        self['gather_facts'] = gather_facts
+        self['serial'] = None
 
     def to_dict(self):
-        return {
+        out = {
             "name": self['name'],
             "hosts": self['hosts'],
             "tasks": [task.to_dict() for task in self['tasks']],
-            "gather_facts": False
+            "gather_facts": self['gather_facts']
         }
+        if self['serial'] is not None:
+            out["serial"] = self['serial']
+        return out
+
+
+class HostTasksPlay(Play):
+    # One play over many hosts in which every host runs only its own tasks.
+    # A play has a single task list for all of its hosts, so each host's
+    # tasks are written to a file of their own that the host includes by
+    # its name. No host dispatches, or skips, the tasks of another.
+
+    def __init__(self, name: str, host_tasks: dict[str, list[Task]]):
+        super().__init__(name=name,
+                         tasks=[task for tasks in host_tasks.values()
+                                for task in tasks],
+                         hosts=list(host_tasks))
+        self['host_tasks'] = host_tasks
+        self['task_files'] = {}
+
+    def write_task_files(self, prefix: str):
+        for number, (host, tasks) in enumerate(self['host_tasks'].items()):
+            path = Path(f"{prefix}.{number}.yml").resolve()
+            with open(path, 'w') as file:
+                yaml_lib.dump([task.to_dict() for task in tasks], file)
+            self['task_files'][host] = str(path)
+
+    def to_dict(self):
+        out = super().to_dict()
+        out["vars"] = {"docker_deploy_task_files": self['task_files']}
+        out["tasks"] = [{
+            "name": "Run the tasks of this host",
+            "include_tasks":
+                "{{ docker_deploy_task_files[inventory_hostname] }}"
+        }]
+        return out
 
 
 class Playbook(dict):
@@ -37,76 +76,86 @@ class Playbook(dict):
         return [play.to_dict() for play in self['plays']]
 
     def write(self, file_path: str):
+        # Task files of a play go next to the playbook.
+        for number, play in enumerate(self['plays']):
+            if isinstance(play, HostTasksPlay):
+                play.write_task_files(f"{file_path}.{number}")
         with open(file_path, 'w') as file:
-            yaml.dump(self.to_dict(), file)
-
-    def run(self, inventory_file: str | None):
-        playbook_tmp = "generated_playbook.yml"
-        self.write(playbook_tmp)
-        args = ['ansible-playbook', playbook_tmp]
-        if inventory_file is not None:
-            args.extend(['-i', inventory_file])
-        else:
-            user = subprocess.run(
-                ['whoami'],
-                check=True,
-                capture_output=True,
-                text=True
-            ).stdout.strip()
-            args.extend(['-u', user])
-
-        print(" ".join(args))
-        try:
-            result = subprocess.run(
-                args,
-                check=True,
-                capture_output=True,
-                text=True
-            )
-            logging.info(result.stdout)
-        except subprocess.CalledProcessError as e:
-            logging.error(
-                f"Command '{e.cmd}' returned non-zero exit status "
-                f"{e.returncode}.")
-            logging.error(e.stderr)
-            logging.error(e.stdout)
-
-
-def get_hostnames(inventory_file: str) -> list[str]:
+            yaml_lib.dump(self.to_dict(), file)
+
+    def run(self, inventory_file: str | None,
+            execution: Execution | None = None) -> EventReport:
+        if execution is None:
+            execution = Execution()
+        for play in self['plays']:
+            play['serial'] = execution.serial
+
+        report = get_executor(inventory_file, execution).run(self,
+                                                             inventory_file)
+        report.log_latency()
+        return report
+
+
+def batch_by_host(plays: list[Play]) -> list[Play]:
+    # Instance plays are merged into one play over all of their hosts, in
+    # which each host runs a block per instance placed on it. The hosts
+    # work through their instances in parallel rather than play by play.
+    batched = []
+    host_tasks: dict[str, list[Task]] = {}
+    position = None
+    for play in plays:
+        if play['instance_id'] is None or len(play['hosts']) != 1:
+            batched.append(play)
+            continue
+
+        if position is None:
+            position = len(batched)
+        host_tasks.setdefault(play['hosts'][0], []).append(Block(
+            name=play['name'],
+            tasks=play['tasks'],
+            variables={'docker_deploy_instance': play['instance_id']}
+        ))
+
+    if position is not None:
+        count = sum(map(len, host_tasks.values()))
+        batched.insert(position, HostTasksPlay(
+            name=f"{count} instances on {', '.join(host_tasks)}",
+            host_tasks=host_tasks
+        ))
+    return batched
+
+
+def instance_hosts(plays: list[Play]) -> dict[str, str]:
+    return {play['instance_id']: play['hosts'][0] for play in plays
+            if play['instance_id'] is not None and len(play['hosts']) == 1}
+
+
+def get_hosts(inventory_file: str | None) -> dict[str, dict]:
+    if inventory_file is None:
+        return {'localhost': {}}
+
+    # ansible is only imported when an inventory has to be read, since
+    # loading it dominates the start-up time of every command.
+    from ansible.inventory.helpers import get_group_vars
+    from ansible.inventory.manager import InventoryManager
+    from ansible.parsing.dataloader import DataLoader
+
     loader = DataLoader()
     inventory = InventoryManager(loader=loader, sources=[inventory_file])
-    hostnames = []
+    hosts = {}
     for host in inventory.get_hosts():
-        hostnames.append(str(host.name))
-    if len(hostnames) == 0:
-        hostnames = ['localhost']
-    return hostnames
-
-
-def next_hostname(possible_hosts: list[str], backends: list[Instance]):
-    backend_counts = {host: 0 for host in possible_hosts}
-    for backend in backends:
-        for service in backend.services:
-            host = service.host.split(':')[0]
-            if host == '127.0.0.1':
-                continue
-            if host not in backend_counts:
-                logging.error(f"Host {host} not found in inventory.")
-                continue
-            backend_counts[host] += 1
-
-    return min(backend_counts, key=backend_counts.get)
-
-
-def get_host_for_instance(
-        instance_id: int, instances: list[Instance]
-) -> str:
-    hosts = set()
-    for instance in instances:
-        if instance.id != instance_id:
-            continue
-        for service in instance.services:
-            hosts.add(service.host.split(':')[0])
+        host_vars = get_group_vars(host.get_groups())
+        host_vars.update(host.get_vars())
+        # Round trip through JSON to drop ansible's own string types.
+        hosts[str(host.name)] = json.loads(json.dumps(host_vars, default=str))
+    if len(hosts) == 0:
+        hosts = {'localhost': {}}
+    return hosts
+
+
+def get_host_for_instance(instance_id, backend_map: BackendMap) -> str:
+    instance = backend_map.get_instance(instance_id)
+    hosts = set() if instance is None else instance.hosts()
     if len(hosts) == 0:
         hosts.add('localhost')
     if len(hosts) > 1:
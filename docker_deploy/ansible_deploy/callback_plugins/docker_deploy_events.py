@@ -0,0 +1,61 @@
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+DOCUMENTATION = '''
+    name: docker_deploy_events
+    type: aggregate
+    short_description: Streams task events to docker-deploy
+    description:
+      - Writes one JSON line per finished task and host to the file
+        descriptor in DOCKER_DEPLOY_EVENTS_FD, with the instance taken from
+        the docker_deploy_instance variable of the enclosing block.
+'''
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'docker_deploy_events'
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self):
+        super().__init__()
+        fd = os.environ.get('DOCKER_DEPLOY_EVENTS_FD')
+        self.stream = None if fd is None else os.fdopen(int(fd), 'w',
+                                                        buffering=1)
+        self.started = {}
+
+    def v2_runner_on_start(self, host, task):
+        self.started[(host.get_name(), task._uuid)] = time.time()
+
+    def emit(self, result, status: str):
+        host = result._host.get_name()
+        task = result._task
+        start = self.started.pop((host, task._uuid), None)
+        if self.stream is None:
+            return
+        self.stream.write(json.dumps({
+            'host': host,
+            'task': task.get_name(),
+            'instance': task.get_vars().get('docker_deploy_instance'),
+            'start': start,
+            'end': time.time(),
+            'status': status
+        }) + "\n")
+
+    def v2_runner_on_ok(self, result):
+        self.emit(result, 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.emit(result, 'ignored' if ignore_errors else 'failed')
+
+    def v2_runner_on_unreachable(self, result):
+        self.emit(result, 'unreachable')
+
+    def v2_runner_on_skipped(self, result):
+        # Every other host skips an instance's block; only the host it runs
+        # on is reported.
+        self.started.pop((result._host.get_name(), result._task._uuid), None)
@@ -0,0 +1,84 @@
+import json
+import logging
+import threading
+from dataclasses import dataclass
+
+FAILED = {'failed', 'unreachable'}
+
+
+@dataclass
+class TaskEvent:
+    host: str
+    task: str
+    instance: str | None
+    start: float | None
+    end: float
+    status: str
+
+
+class EventReport:
+    # Task events of one playbook run, from the callback plugin or the local
+    # executor, grouped by the instance block they ran in.
+
+    def __init__(self):
+        self.events: list[TaskEvent] = []
+        # Exit status of ansible-playbook, 0 when the tasks ran in-process.
+        self.returncode = 0
+        self._lock = threading.Lock()
+
+    def add(self, event: TaskEvent):
+        with self._lock:
+            self.events.append(event)
+        if event.status in FAILED:
+            logging.error(f"Task '{event.task}' {event.status} on "
+                          f"{event.host}" + ("" if event.instance is None else
+                                             f" (instance {event.instance})"))
+
+    def read(self, stream):
+        for line in stream:
+            try:
+                self.add(TaskEvent(**json.loads(line)))
+            except (ValueError, TypeError):
+                logging.warning(f"Ignoring malformed task event: {line!r}")
+
+    def failed_instances(self, instance_hosts: dict[str, str]) -> set[str]:
+        # A failed task stops its host, so the instances on that host that
+        # never got to run count as failed too. When ansible itself failed,
+        # possibly before running any task, every instance without a task
+        # that went through counts as failed.
+        failed = set()
+        failed_hosts = set()
+        started = set()
+        succeeded = set()
+        for event in self.events:
+            started.add(event.instance)
+            if event.status == 'ok':
+                succeeded.add(event.instance)
+            if event.status in FAILED:
+                failed_hosts.add(event.host)
+                if event.instance is not None:
+                    failed.add(event.instance)
+        for instance_id, host in instance_hosts.items():
+            if host in failed_hosts and instance_id not in started:
+                failed.add(instance_id)
+            if self.returncode != 0 and instance_id not in succeeded:
+                failed.add(instance_id)
+        return failed
+
+    def log_latency(self):
+        by_instance: dict[str, list[TaskEvent]] = {}
+        for event in self.events:
+            if event.instance is not None and event.start is not None:
+                by_instance.setdefault(event.instance, []).append(event)
+
+        def elapsed(events: list[TaskEvent]) -> float:
+            return max(e.end for e in events) - min(e.start for e in events)
+
+        # Slowest instances first.
+        for instance_id, events in sorted(by_instance.items(),
+                                          key=lambda item: -elapsed(item[1])):
+            slowest = max(events, key=lambda e: e.end - e.start)
+            logging.info(f"Instance {instance_id} on {events[0].host}: "
+                         f"{elapsed(events):.2f}s over {len(events)} tasks, "
+                         f"slowest '{slowest.task}' "
+                         f"{slowest.end - slowest.start:.2f}s")
@@ -0,0 +1,191 @@
+import getpass
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from docker_deploy import metrics_lib
+from docker_deploy.ansible_deploy.events import EventReport, TaskEvent
+from docker_deploy.ansible_deploy.task import Task, Block
+from docker_deploy.config_lib import Execution
+
+CALLBACK_PLUGINS = Path(__file__).parent / 'callback_plugins'
+EVENTS_CALLBACK = 'docker_deploy_events'
+
+
+class Executor:
+
+    def run(self, playbook, inventory_file: str | None) -> EventReport:
+        raise NotImplementedError
+
+
+class AnsibleExecutor(Executor):
+
+    def __init__(self, execution: Execution):
+        self.execution = execution
+
+    def env(self) -> dict[str, str]:
+        env = os.environ.copy()
+        env['ANSIBLE_FORKS'] = str(self.execution.forks)
+        env['ANSIBLE_STRATEGY'] = self.execution.strategy
+        env['ANSIBLE_PIPELINING'] = str(self.execution.pipelining)
+        env['ANSIBLE_CALLBACK_PLUGINS'] = os.pathsep.join(
+            filter(None, [str(CALLBACK_PLUGINS),
+                          env.get('ANSIBLE_CALLBACK_PLUGINS')]))
+        env['ANSIBLE_CALLBACKS_ENABLED'] = ','.join(
+            filter(None, [EVENTS_CALLBACK,
+                          env.get('ANSIBLE_CALLBACKS_ENABLED')]))
+        if self.execution.control_persist is not None:
+            env['ANSIBLE_SSH_ARGS'] = (f"-C -o ControlMaster=auto "
+                                       f"-o ControlPersist="
+                                       f"{self.execution.control_persist}")
+        return env
+
+    def run(self, playbook, inventory_file: str | None) -> EventReport:
+        # A directory, as the playbook comes with the task files of its
+        # plays.
+        playbook_dir = tempfile.mkdtemp(prefix='generated_playbook_', dir='.')
+        try:
+            return self.run_playbook(
+                playbook, str(Path(playbook_dir) / 'playbook.yml'),
+                inventory_file)
+        finally:
+            shutil.rmtree(playbook_dir)
+
+    def run_playbook(self, playbook, playbook_tmp: str,
+                     inventory_file: str | None) -> EventReport:
+        with metrics_lib.span('playbook_write'):
+            playbook.write(playbook_tmp)
+        args = ['ansible-playbook', playbook_tmp]
+        if inventory_file is not None:
+            args.extend(['-i', inventory_file])
+        else:
+            args.extend(['-u', getpass.getuser()])
+
+        print(" ".join(args))
+        # The callback plugin writes task events to a pipe while the output
+        # is logged line by line, both as ansible goes.
+        report = EventReport()
+        events_read, events_write = os.pipe()
+        env = self.env()
+        env['DOCKER_DEPLOY_EVENTS_FD'] = str(events_write)
+        with subprocess.Popen(
+                args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                env=env,
+                pass_fds=(events_write,)
+        ) as process:
+            os.close(events_write)
+            with open(events_read, 'r') as events:
+                reader = threading.Thread(target=report.read, args=(events,))
+                reader.start()
+                for line in process.stdout:
+                    if line.strip():
+                        logging.info(line.rstrip())
+                reader.join()
+        report.returncode = process.returncode
+        if process.returncode != 0:
+            logging.error(
+                f"Command '{args}' returned non-zero exit status "
+                f"{process.returncode}.")
+        return report
+
+
+class LocalExecutor(Executor):
+    # Runs the tasks of a localhost playbook directly in this process.
+    # Consecutive blocks (one per instance) run concurrently; everything
+    # else runs in order.
+
+    def __init__(self, workers: int):
+        self.workers = workers
+
+    def run(self, playbook, inventory_file: str | None) -> EventReport:
+        report = EventReport()
+        user = getpass.getuser()
+        variables = {
+            'ansible_user': user,
+            'inventory_hostname': 'localhost'
+        }
+        if not Path(f"/home/{user}").is_dir():
+            logging.warning(f"/home/{user} does not exist.")
+
+        for play in playbook['plays']:
+            logging.info(f"Running play '{play['name']}' locally.")
+            pending_blocks = []
+            for task in play['tasks']:
+                if isinstance(task, Block):
+                    pending_blocks.append(task)
+                    continue
+                self.run_blocks(pending_blocks, variables, report)
+                pending_blocks = []
+                if not self.run_timed(task, variables, report):
+                    return report
+            self.run_blocks(pending_blocks, variables, report)
+        return report
+
+    def run_blocks(self, blocks: list[Block], variables: dict[str, str],
+                   report: EventReport):
+        if len(blocks) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(
+                lambda block: self.run_block(block, variables, report),
+                blocks))
+
+    def run_block(self, block: Block, variables: dict[str, str],
+                  report: EventReport) -> bool:
+        instance_id = (block['vars'] or {}).get('docker_deploy_instance')
+        for task in block['args']:
+            if not self.run_timed(task, variables, report, instance_id):
+                return False
+        return True
+
+    def run_timed(self, task: Task, variables: dict[str, str],
+                  report: EventReport, instance_id: str | None = None
+                  ) -> bool:
+        start = time.time()
+        ok = self.run_task(task, variables)
+        report.add(TaskEvent(
+            host=variables['inventory_hostname'],
+            task=task['name'],
+            instance=instance_id,
+            start=start,
+            end=time.time(),
+            status='ok' if ok else 'failed'
+        ))
+        return ok
+
+    @staticmethod
+    def run_task(task: Task, variables: dict[str, str]) -> bool:
+        try:
+            task.run_local(variables)
+            logging.info(f"Task '{task['name']}' completed.")
+            return True
+        except subprocess.CalledProcessError as e:
+            logging.error(
+                f"Task '{task['name']}': command '{e.cmd}' returned "
+                f"non-zero exit status {e.returncode}.")
+            logging.error(e.stderr)
+            logging.error(e.stdout)
+        except (OSError, NotImplementedError) as e:
+            logging.error(f"Task '{task['name']}' failed: {e}")
+        return False
+
+
+def get_executor(inventory_file: str | None,
+                 execution: Execution) -> Executor:
+    # The local executor runs every task on this machine and ignores which
+    # host a block is for, so it is only used without an inventory.
+    if execution.executor == 'local' and inventory_file is not None:
+        logging.warning("The local executor cannot run against an inventory,"
+                        " using ansible instead.")
+    if execution.executor in ('local', 'auto') and inventory_file is None:
+        return LocalExecutor(execution.forks)
+    return AnsibleExecutor(execution)
@@ -1,5 +1,19 @@
+import fcntl
+import hashlib
+import os
+import re
+import shlex
+import shutil
+import subprocess
 from pathlib import Path
 
+FICLONE = 0x40049409  # from linux/fs.h
+VARIABLE_PATTERN = re.compile(r'{{\s*(\w+)\s*}}')
+
+
+def render(value: str, variables: dict[str, str]) -> str:
+    return VARIABLE_PATTERN.sub(lambda match: variables[match.group(1)], value)
+
 
 class Task(dict):
 
@@ -15,28 +29,111 @@ class Task(dict):
             self['action']: self['args']
         }
 
+    def run_local(self, variables: dict[str, str]):
+        raise NotImplementedError(
+            f"Task '{self['name']}' ({self['action']}) cannot run locally")
+
 
 class Mkdir(Task):
 
     def __init__(self, name: str, path: str):
         super().__init__(name, 'file', {'path': path, 'state': 'directory'})
 
+    def run_local(self, variables: dict[str, str]):
+        Path(render(self['args']['path'], variables)).mkdir(
+            parents=True, exist_ok=True)
+
+
+def remove_path(path: Path):
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
 
-class Copy(Task):
+
+def reflink_copy(src: str, dest: str):
+    # Clones the file's extents on filesystems that support it (btrfs, xfs),
+    # like `cp --reflink=auto`, and falls back to a plain copy elsewhere.
+    try:
+        with open(src, 'rb') as source, open(dest, 'wb') as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        shutil.copystat(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+class Sync(Task):
+    # Mirrors a directory with rsync, comparing file contents, so only
+    # changed files are transferred and files removed from src go away.
 
     def __init__(self, name: str, src: str, dest: str):
-        if Path(src).is_dir():
-            src = src.rstrip('/') + "/."
-            dest = dest.rstrip('/')
-        super().__init__(name, 'copy', {'src': src, 'dest': dest})
+        super().__init__(name, 'ansible.posix.synchronize', {
+            'src': src.rstrip('/') + '/',
+            'dest': dest.rstrip('/'),
+            'checksum': True,
+            'delete': True,
+            'recursive': True
+        })
+
+    def run_local(self, variables: dict[str, str]):
+        src = Path(render(self['args']['src'], variables))
+        dest = Path(render(self['args']['dest'], variables))
+        dest.mkdir(parents=True, exist_ok=True)
+        for root, dirs, files in os.walk(dest, topdown=False):
+            for name in files + dirs:
+                target = Path(root) / name
+                if not os.path.lexists(src / target.relative_to(dest)):
+                    remove_path(target)
+        for root, dirs, files in os.walk(src):
+            target_root = dest / Path(root).relative_to(src)
+            for name in dirs + files:
+                source, target = Path(root) / name, target_root / name
+                if source.is_symlink():
+                    link = os.readlink(source)
+                    if not target.is_symlink() or os.readlink(target) != link:
+                        remove_path(target)
+                        target.symlink_to(link)
+                elif source.is_dir():
+                    if target.is_symlink() or not target.is_dir():
+                        remove_path(target)
+                        target.mkdir()
+                elif target.is_symlink() or target.is_dir() or \
+                        not same_content(source, target):
+                    remove_path(target)
+                    reflink_copy(str(source), str(target))
+
+
+def same_content(source: Path, target: Path) -> bool:
+    try:
+        if source.stat().st_size != target.stat().st_size:
+            return False
+        with open(source, 'rb') as first, open(target, 'rb') as second:
+            return hashlib.file_digest(first, 'sha256').digest() == \
+                hashlib.file_digest(second, 'sha256').digest()
+    except FileNotFoundError:
+        return False
 
 
 class LocalCopy(Task):
 
     def __init__(self, name: str, src: str, dest: str, is_dir: bool = False):
-        recursive = "-r" if is_dir else ""
+        recursive = "-r " if is_dir else ""
         super().__init__(name, 'command',
-                         {'cmd': f"cp {recursive} {src} {dest}"})
+                         {'cmd': f"cp {recursive}--reflink=auto {src} {dest}"})
+        self.src = src
+        self.dest = dest
+        self.is_dir = is_dir
+
+    def run_local(self, variables: dict[str, str]):
+        src = render(self.src, variables)
+        dest = render(self.dest, variables)
+        if self.is_dir:
+            if Path(dest).is_dir():
+                dest = str(Path(dest) / Path(src).name)
+            shutil.copytree(src, dest, symlinks=True,
+                            copy_function=reflink_copy)
+        else:
+            reflink_copy(src, dest)
 
 
 class WriteFile(Task):
@@ -44,12 +141,19 @@ class WriteFile(Task):
     def __init__(self, name: str, path: str, content: str):
         super().__init__(name, 'copy', {'content': content, 'dest': path})
 
+    def run_local(self, variables: dict[str, str]):
+        with open(render(self['args']['dest'], variables), 'w') as file:
+            file.write(render(self['args']['content'], variables))
+
 
 class Rm(Task):
 
     def __init__(self, name: str, path: str):
         super().__init__(name, 'file', {'path': path, 'state': 'absent'})
 
+    def run_local(self, variables: dict[str, str]):
+        remove_path(Path(render(self['args']['path'], variables)))
+
 
 class DockerCompose(Task):
 
@@ -63,3 +167,51 @@ class DockerCompose(Task):
                        f"{args}; fi'",
                 'chdir': path
             })
+
+    def run_local(self, variables: dict[str, str]):
+        subprocess.run(
+            shlex.split(render(self['args']['cmd'], variables)),
+            cwd=render(self['args']['chdir'], variables),
+            check=True,
+            capture_output=True,
+            text=True
+        )
+
+
+class Shell(Task):
+
+    def __init__(self, name: str, cmd: str, chdir: str):
+        super().__init__(name, 'shell', {'cmd': cmd, 'chdir': chdir,
+                                         'executable': '/bin/bash'})
+
+    def run_local(self, variables: dict[str, str]):
+        subprocess.run(
+            render(self['args']['cmd'], variables),
+            shell=True,
+            executable=self['args']['executable'],
+            cwd=render(self['args']['chdir'], variables),
+            check=True,
+            capture_output=True,
+            text=True
+        )
+
+
+class Block(Task):
+
+    def __init__(self, name: str, tasks: list[Task],
+                 variables: dict[str, str] | None = None):
+        super().__init__(name, 'block', tasks)
+        self['vars'] = variables
+
+    def to_dict(self):
+        out = {
+            "name": self['name'],
+            "block": [task.to_dict() for task in self['args']]
+        }
+        if self['vars'] is not None:
+            out["vars"] = self['vars']
+        return out
+
+    def run_local(self, variables: dict[str, str]):
+        for task in self['args']:
+            task.run_local(variables)
@@ -1,10 +1,14 @@
+import contextlib
+import hashlib
 import logging
+import os
 import subprocess
-from dataclasses import dataclass
-
-import yaml
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
 
 from docker_deploy import config_lib
+from docker_deploy import yaml_lib
 
 
 @dataclass
@@ -88,6 +92,12 @@ class Instance:
             "services": [service.to_dict() for service in self.services]
         }
 
+    def ports(self) -> list[int]:
+        return [int(service.host.split(':')[1]) for service in self.services]
+
+    def hosts(self) -> set[str]:
+        return {service.host.split(':')[0] for service in self.services}
+
     @classmethod
     def from_dict(cls, data):
         return cls(
@@ -102,6 +112,89 @@ class BackendMap:
     lb_endpoint: str
     layout: list[Box]
     backends: list[Instance]
+    # Indexes over backends, kept up to date by add_instance and
+    # remove_instance. Mutating backends directly requires reindex().
+    _by_id: dict[str, Instance] = field(
+        default_factory=dict, init=False, repr=False, compare=False)
+    _host_instances: dict[str, set[str]] = field(
+        default_factory=dict, init=False, repr=False, compare=False)
+    _host_services: dict[str, int] = field(
+        default_factory=dict, init=False, repr=False, compare=False)
+    _ports: set[int] = field(
+        default_factory=set, init=False, repr=False, compare=False)
+    # Changes since the state was last committed, for journaling stores.
+    _changes: list[dict] = field(
+        default_factory=list, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.reindex()
+
+    def reindex(self):
+        self._by_id = {}
+        self._host_instances = {}
+        self._host_services = {}
+        self._ports = set()
+        for instance in self.backends:
+            self._index(instance)
+
+    def _index(self, instance: Instance):
+        self._by_id[str(instance.id)] = instance
+        for service in instance.services:
+            host, port = service.host.split(':')
+            self._host_instances.setdefault(host, set()).add(str(instance.id))
+            self._host_services[host] = self._host_services.get(host, 0) + 1
+            self._ports.add(int(port))
+
+    def _unindex(self, instance: Instance):
+        del self._by_id[str(instance.id)]
+        for service in instance.services:
+            host, port = service.host.split(':')
+            self._host_instances[host].discard(str(instance.id))
+            self._host_services[host] -= 1
+            self._ports.discard(int(port))
+
+    def add_instance(self, instance: Instance):
+        if str(instance.id) in self._by_id:
+            raise ValueError(f"Instance {instance.id} already exists")
+        self.backends.append(instance)
+        self._index(instance)
+        self._changes.append({'op': 'add', 'instance': instance.to_dict()})
+
+    def remove_instance(self, instance_id) -> Instance | None:
+        instance = self._by_id.get(str(instance_id))
+        if instance is None:
+            return None
+        self._unindex(instance)
+        for i, backend in enumerate(self.backends):
+            if backend is instance:
+                del self.backends[i]
+                break
+        self._changes.append({'op': 'remove', 'id': str(instance_id)})
+        return instance
+
+    def clear(self):
+        self.backends = []
+        self.reindex()
+        self._changes.append({'op': 'clear'})
+
+    def pending_changes(self) -> list[dict]:
+        return self._changes
+
+    def get_instance(self, instance_id) -> Instance | None:
+        return self._by_id.get(str(instance_id))
+
+    def instance_ids_on_host(self, host: str) -> set[str]:
+        return self._host_instances.get(host, set())
+
+    def service_count(self, host: str) -> int:
+        return self._host_services.get(host, 0)
+
+    def used_ports(self) -> set[int]:
+        return self._ports
+
+    def next_instance_id(self) -> int:
+        return max([int(instance_id) for instance_id in self._by_id] +
+                   [0]) + 1
 
     def to_dict(self):
         return {
@@ -120,12 +213,47 @@ class BackendMap:
         )
 
 
-def save_backend_map(backend_map: BackendMap, output_file: str,
-                     launch_command: dict[str]):
-    with open(output_file, 'w') as file:
-        yaml.dump(backend_map.to_dict(), file)
+def atomic_write(path: Path, content: str):
+    path = Path(path)
+    # A unique temp file per writer, so concurrent writers of the same path
+    # each replace it whole instead of racing on one temp name.
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp",
+                               dir=path.parent)
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+        raise
+    fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_backend_map(backend_map: BackendMap, output_file: str) -> bool:
+    content = yaml_lib.dump(backend_map.to_dict())
+    try:
+        with open(output_file, 'rb') as file:
+            current_hash = hashlib.sha256(file.read()).digest()
+    except FileNotFoundError:
+        current_hash = None
+    if current_hash == hashlib.sha256(content.encode()).digest():
+        logging.info(f'Backend map {output_file} unchanged')
+        return False
+
+    atomic_write(Path(output_file), content)
     logging.info(f'Backend map saved to {output_file}')
+    return True
+
 
+def run_launch_command(launch_command: dict[str]):
     subprocess.run(launch_command["command"], cwd=launch_command["context"],
                    shell=True, check=True)
     logging.info(f'Launch command executed: {launch_command}')
@@ -133,7 +261,7 @@ def save_backend_map(backend_map: BackendMap, output_file: str,
 
 def load_backend_map(file_path: str) -> BackendMap:
     with open(file_path, 'r') as file:
-        data = yaml.safe_load(file)
+        data = yaml_lib.load(file)
         return BackendMap.from_dict(data)
 
 
@@ -182,7 +310,8 @@ def config_boxes_to_backend_map_boxes(boxes: list[config_lib.Box]) -> list[Box]:
 
 
 def build_backend_map_base(target_location: str, lb_endpoint: str,
-                           boxes: list[config_lib.Box]) -> BackendMap:
+                           boxes: list[config_lib.Box],
+                           layout: list[Box] | None = None) -> BackendMap:
     try:
         backend_map = load_backend_map(target_location)
         logging.info(f'Loaded existing backend map from {target_location}')
@@ -191,8 +320,10 @@ def build_backend_map_base(target_location: str, lb_endpoint: str,
         logging.info('No existing backend map found. Creating new backend map.')
     except KeyError:
         logging.error('Invalid backend map file. Creating new backend map.')
+    if layout is None:
+        layout = config_boxes_to_backend_map_boxes(boxes)
     return BackendMap(
         lb_endpoint=lb_endpoint,
-        layout=config_boxes_to_backend_map_boxes(boxes),
+        layout=layout,
         backends=[]
     )
@@ -0,0 +1,306 @@
+import argparse
+import copy
+import json
+import os
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from docker_deploy import backend_map_lib
+from docker_deploy import config_lib
+from docker_deploy import deploy
+from docker_deploy import docker
+from docker_deploy import scheduler_lib
+from docker_deploy import yaml_lib
+from docker_deploy.ansible_deploy import Play, Playbook, batch_by_host, \
+    get_host_for_instance
+from docker_deploy.ansible_deploy.events import EventReport
+from docker_deploy.ansible_deploy.executor import Executor
+from docker_deploy.ansible_deploy.task import Mkdir, WriteFile, Rm, Shell
+
+RESULTS_FILE = "benchmark-results.jsonl"
+
+
+class FakeExecutor(Executor):
+    # Walks the playbook like an executor would and records the tasks
+    # instead of running them.
+
+    def __init__(self):
+        self.tasks = []
+
+    def run(self, playbook, inventory_file: str | None) -> EventReport:
+        for play in playbook['plays']:
+            for task in play['tasks']:
+                self.tasks.append((play['hosts'], task.to_dict()))
+        return EventReport()
+
+
+def synthetic_plays(count: int, work_dir: str,
+                    hosts: list[str] = ('localhost',),
+                    delay: float = 0) -> list[Play]:
+    # With a delay, each instance also waits that long, like a host would on
+    # docker, so hosts waiting on each other shows up in the timings.
+    plays = []
+    for instance_id in range(1, count + 1):
+        instance_dir = Path(work_dir) / str(instance_id)
+        tasks = [
+            Mkdir(name="Create instance directory", path=str(instance_dir)),
+            WriteFile(name="Write docker-compose.yml",
+                      path=str(instance_dir / 'docker-compose.yml'),
+                      content="services: {}\n"),
+        ]
+        if delay > 0:
+            tasks.append(Shell(name="Wait for docker", cmd=f"sleep {delay}",
+                               chdir=str(instance_dir)))
+        tasks.append(Rm(name="Delete instance directory",
+                        path=str(instance_dir)))
+        plays.append(Play(
+            name=f'Deploy Instance {instance_id}',
+            tasks=tasks,
+            hosts=[hosts[instance_id % len(hosts)]],
+            instance_id=str(instance_id)
+        ))
+    return plays
+
+
+def time_playbook(playbook: Playbook, work_dir: str, hosts: list[str],
+                  strategy: str) -> float:
+    # Every host is an alias of this machine over the local connection.
+    playbook_file = str(Path(work_dir) / 'benchmark_playbook.yml')
+    playbook.write(playbook_file)
+    start = time.perf_counter()
+    subprocess.run(
+        ['ansible-playbook', playbook_file, '-i', ','.join(hosts) + ',',
+         '-c', 'local', '-f', str(len(hosts))],
+        check=True,
+        capture_output=True,
+        text=True,
+        env={**os.environ, 'ANSIBLE_STRATEGY': strategy}
+    )
+    return time.perf_counter() - start
+
+
+def benchmark_batching(count: int, host_count: int, delay: float):
+    hosts = [f'host{number}' for number in range(1, host_count + 1)]
+    with tempfile.TemporaryDirectory() as work_dir:
+        plays = synthetic_plays(count, work_dir, hosts, delay)
+        batched = batch_by_host(plays)
+        per_instance = time_playbook(Playbook(plays), work_dir, hosts,
+                                     'linear')
+        linear = time_playbook(Playbook(batched), work_dir, hosts, 'linear')
+        free = time_playbook(Playbook(batched), work_dir, hosts, 'free')
+
+    print(f"instances:            {count} on {host_count} hosts, "
+          f"{delay}s delay each")
+    print(f"per-instance plays:   {len(plays):>5}  {per_instance:8.2f}s")
+    print(f"batched, linear:      {len(batched):>5}  {linear:8.2f}s  "
+          f"{per_instance / linear:5.2f}x")
+    print(f"batched, free:        {len(batched):>5}  {free:8.2f}s  "
+          f"{per_instance / free:5.2f}x")
+
+
+def synthetic_config(boxes: int, services: int, instances: int,
+                     work_dir: str) -> config_lib.Config:
+    target = Path(work_dir) / 'docker'
+    target.mkdir()
+    config_boxes = [
+        config_lib.Box(
+            name=f'box{box}',
+            services=[config_lib.Service(
+                name=f'Service {service}',
+                description=f'Synthetic service {service} of box {box}',
+                port=8000 + service,
+                protocol='http'
+            ) for service in range(services)],
+            cpus=0.01,
+            memory=16
+        ) for box in range(boxes)
+    ]
+    compose = {'services': {
+        box.name: {'image': f'synthetic/{box.name}:latest',
+                   'environment': ['SYNTHETIC=1']}
+        for box in config_boxes
+    }}
+    (target / 'docker-compose.yml').write_text(yaml_lib.dump(compose))
+    return config_lib.Config(
+        version=1,
+        output=config_lib.Output(
+            backend_map=str(Path(work_dir) / 'backend-map.yml'),
+            min_port=1024,
+            max_port=1024 + instances * boxes * services,
+            interface_ip='127.0.0.1'
+        ),
+        target=str(target),
+        lb_endpoint='http://localhost:8000',
+        launch_command={'context': work_dir, 'command': 'true'},
+        stop_command={'context': work_dir, 'command': 'true'},
+        boxes=config_boxes
+    )
+
+
+def synthetic_hosts(count: int) -> dict[str, dict]:
+    return {f'10.0.{host // 250}.{host % 250 + 1}': {
+        'docker_deploy_cpus': 16 * (1 + host % 4),
+        'docker_deploy_memory': 65536
+    } for host in range(count)}
+
+
+def write_inventory(hosts: dict[str, dict], work_dir: str) -> str:
+    inventory = Path(work_dir) / 'inventory.ini'
+    inventory.write_text("[all]\n" + "".join(
+        f"{host} " + " ".join(f"{key}={value}"
+                              for key, value in host_vars.items()) + "\n"
+        for host, host_vars in hosts.items()))
+    return str(inventory)
+
+
+def measure(results: dict, name: str, ops: int, run, setup=lambda: None,
+            repeat: int = 3):
+    # Best of `repeat` runs, each on a fresh input from `setup`.
+    best = None
+    for _ in range(repeat):
+        argument = setup()
+        start = time.perf_counter()
+        run(argument)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    results[name] = {'seconds': best, 'ops': ops}
+    print(f"{name:<24} {ops:>8}  {best:9.4f}s  "
+          f"{best / max(ops, 1) * 1e6:10.1f}us/op")
+
+
+def git_revision() -> str | None:
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                            capture_output=True, text=True,
+                            cwd=Path(__file__).parent)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def benchmark_scale(instances: int, hosts: int, boxes: int, services: int,
+                    repeat: int, results_file: str):
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        config = synthetic_config(boxes, services, instances, work_dir)
+        host_vars = synthetic_hosts(hosts)
+        layout = backend_map_lib.config_boxes_to_backend_map_boxes(
+            config.boxes)
+
+        def empty_map() -> backend_map_lib.BackendMap:
+            return backend_map_lib.BackendMap(
+                lb_endpoint=config.lb_endpoint, layout=layout, backends=[])
+
+        full_map, plays = deploy.deploy_instances(
+            instances, empty_map(), config, 1, host_vars)
+
+        measure(results, 'deploy_instances', instances,
+                lambda backend_map: deploy.deploy_instances(
+                    instances, backend_map, config, 1, host_vars),
+                empty_map, repeat)
+
+        with open(Path(config.target) / 'docker-compose.yml') as file:
+            compose_text = file.read()
+        compose = yaml_lib.load(compose_text)
+        sample = min(instances, 1000)
+        measure(results, 'adapt_docker_compose', sample,
+                lambda _: [docker.adapt_docker_compose(
+                    1024 + n * boxes * services, '127.0.0.1', layout,
+                    config.boxes, copy.deepcopy(compose))
+                    for n in range(sample)],
+                repeat=repeat)
+        template = docker.ComposeTemplate(compose_text, layout, config.boxes)
+        measure(results, 'compose_template', instances,
+                lambda _: [template.render(1024 + n * boxes * services,
+                                           '127.0.0.1')
+                           for n in range(instances)],
+                repeat=repeat)
+
+        measure(results, 'placement', instances,
+                lambda _: scheduler_lib.Scheduler(
+                    host_vars, config.boxes).place(instances, [empty_map()]),
+                repeat=repeat)
+        instance_ids = [instance.id for instance in full_map.backends]
+        measure(results, 'get_host_for_instance', instances,
+                lambda _: [get_host_for_instance(instance_id, full_map)
+                           for instance_id in instance_ids],
+                repeat=repeat)
+
+        backend_map_file = config.output.backend_map
+        measure(results, 'write_backend_map', instances,
+                lambda _: backend_map_lib.write_backend_map(
+                    full_map, backend_map_file),
+                lambda: Path(backend_map_file).unlink(missing_ok=True),
+                repeat)
+        measure(results, 'load_backend_map', instances,
+                lambda _: backend_map_lib.load_backend_map(backend_map_file),
+                repeat=repeat)
+
+        playbook = Playbook(batch_by_host(plays))
+        playbook_file = str(Path(work_dir) / 'playbook.yml')
+        measure(results, 'playbook_write', instances,
+                lambda _: playbook.write(playbook_file), repeat=repeat)
+        measure(results, 'fake_executor', instances,
+                lambda executor: executor.run(playbook, None),
+                FakeExecutor, repeat)
+
+        try:
+            from docker_deploy.ansible_deploy import get_hosts
+            inventory = write_inventory(host_vars, work_dir)
+            measure(results, 'inventory_parse', hosts,
+                    lambda _: get_hosts(inventory), repeat=repeat)
+        except ImportError:
+            print("inventory_parse skipped: ansible is not installed")
+
+    with open(results_file, 'a') as file:
+        file.write(json.dumps({
+            'time': time.time(),
+            'revision': git_revision(),
+            'instances': instances,
+            'hosts': hosts,
+            'boxes': boxes,
+            'services': services,
+            'results': results
+        }) + "\n")
+    print(f"Results appended to {results_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark playbook generation and execution.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    batching_parser = subparsers.add_parser(
+        'batching',
+        help='Compare one play per instance against one play per host')
+    batching_parser.add_argument('count', type=int, nargs='?', default=50,
+                                 help='Number of synthetic instances')
+    batching_parser.add_argument('--hosts', type=int, default=4,
+                                 help='Number of hosts to spread them over')
+    batching_parser.add_argument('--delay', type=float, default=2,
+                                 help='Seconds each instance waits, as on '
+                                      'docker')
+
+    scale_parser = subparsers.add_parser(
+        'scale',
+        help='Time the planning hot paths on a synthetic fleet, without '
+             'docker or ansible')
+    scale_parser.add_argument('--instances', type=int, default=10000)
+    scale_parser.add_argument('--hosts', type=int, default=100)
+    scale_parser.add_argument('--boxes', type=int, default=4)
+    scale_parser.add_argument('--services', type=int, default=1,
+                              help='Services per box')
+    scale_parser.add_argument('--repeat', type=int, default=3)
+    scale_parser.add_argument('--results', default=RESULTS_FILE,
+                              help='JSON lines file to append results to')
+
+    args = parser.parse_args()
+
+    if args.command == 'batching':
+        benchmark_batching(args.count, args.hosts, args.delay)
+    elif args.command == 'scale':
+        benchmark_scale(args.instances, args.hosts, args.boxes,
+                        args.services, args.repeat, args.results)
+
+
+if __name__ == '__main__':
+    main()
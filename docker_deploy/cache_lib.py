@@ -0,0 +1,149 @@
+import logging
+import os
+import pickle
+import re
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from docker_deploy import backend_map_lib
+from docker_deploy import config_lib
+from docker_deploy import metrics_lib
+
+# Bump whenever Snapshot, Config or any of the dataclasses in it change
+# shape or defaults, so snapshots pickled by an older release, which carry
+# the old defaults, are rebuilt.
+CACHE_VERSION = 4
+
+
+@dataclass
+class Snapshot:
+    version: int
+    config_key: tuple
+    inventory_key: tuple | None
+    created: float
+    config: config_lib.Config
+    # None when built for a command that does not need the inventory.
+    hosts: dict[str, dict] | None
+    layout: list[backend_map_lib.Box]
+
+
+def file_key(path: str) -> tuple:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return str(Path(path).resolve()), None, None
+    return str(Path(path).resolve()), stat.st_mtime_ns, stat.st_size
+
+
+def is_dynamic(path: Path) -> bool:
+    # Inventory scripts and inventory plugin configs produce their hosts
+    # when run, so their files say nothing about what they return.
+    if os.access(path, os.X_OK):
+        return True
+    if path.suffix in ('.yml', '.yaml'):
+        try:
+            return re.search(r'^plugin:', path.read_text(),
+                             re.MULTILINE) is not None
+        except (OSError, UnicodeDecodeError):
+            return False
+    return False
+
+
+def inventory_key(inventory: str) -> tuple | None:
+    # Every file ansible reads for the inventory: the file itself or all
+    # files under an inventory directory, plus the group_vars and host_vars
+    # next to it. None for dynamic inventories.
+    path = Path(inventory)
+    if path.is_dir():
+        sources = sorted(child for child in path.rglob('*')
+                         if child.is_file() and
+                         not {'group_vars', 'host_vars'} &
+                         set(child.relative_to(path).parts))
+        base = path
+    else:
+        sources = [path]
+        base = path.parent
+    if any(is_dynamic(source) for source in sources if source.exists()):
+        return None
+    var_files = sorted(child for vars_dir in ('group_vars', 'host_vars')
+                       for child in (base / vars_dir).rglob('*')
+                       if child.is_file())
+    return tuple(file_key(str(file)) for file in sources + var_files)
+
+
+def cache_path(config_file: str) -> Path:
+    path = Path(config_file)
+    return path.with_name(f".{path.name}.cache")
+
+
+def is_fresh(snapshot: Snapshot, config_file: str,
+             with_hosts: bool = True) -> bool:
+    if snapshot.version != CACHE_VERSION:
+        return False
+    if snapshot.config_key != file_key(config_file):
+        return False
+    if not with_hosts:
+        return True
+    if snapshot.hosts is None:
+        return False
+    inventory = snapshot.config.inventory
+    if inventory is None:
+        return True
+    key = inventory_key(inventory)
+    if snapshot.inventory_key != key:
+        return False
+    # A dynamic inventory is only cached for inventory_cache_ttl seconds.
+    ttl = snapshot.config.execution.inventory_cache_ttl
+    if ttl is None:
+        return key is not None
+    return time.time() - snapshot.created <= ttl
+
+
+def build_snapshot(config_file: str, with_hosts: bool = True) -> Snapshot:
+    config = config_lib.load_config(config_file)
+    hosts = None
+    if with_hosts:
+        # Imported here so a warm start never loads the ansible helpers.
+        from docker_deploy.ansible_deploy import get_hosts
+
+        with metrics_lib.span('inventory'):
+            hosts = get_hosts(config.inventory)
+    return Snapshot(
+        version=CACHE_VERSION,
+        config_key=file_key(config_file),
+        inventory_key=None if not with_hosts or config.inventory is None
+        else inventory_key(config.inventory),
+        created=time.time(),
+        config=config,
+        hosts=hosts,
+        layout=backend_map_lib.config_boxes_to_backend_map_boxes(
+            config.boxes)
+    )
+
+
+def load_snapshot(config_file: str, with_hosts: bool = True) -> Snapshot:
+    # Without hosts, only the config and layout are needed: a cached
+    # snapshot is used whatever the state of the inventory, and a new one
+    # is built without reading the inventory at all.
+    cache_file = cache_path(config_file)
+    try:
+        with open(cache_file, 'rb') as file:
+            snapshot = pickle.load(file)
+        if isinstance(snapshot, Snapshot) and \
+                is_fresh(snapshot, config_file, with_hosts):
+            return snapshot
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError,
+            AttributeError, TypeError, ImportError, ValueError):
+        pass
+
+    if with_hosts:
+        logging.info(f'Compiling {config_file} and its inventory.')
+    else:
+        logging.info(f'Compiling {config_file}.')
+    snapshot = build_snapshot(config_file, with_hosts)
+    tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+    with open(tmp_file, 'wb') as file:
+        pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+    return snapshot
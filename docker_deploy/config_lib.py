@@ -1,7 +1,7 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional
 
-import yaml
+from docker_deploy import yaml_lib
 
 
 @dataclass
@@ -16,6 +16,8 @@ class Service:
 class Box:
     name: str
     services: list[Service]
+    cpus: float = 0
+    memory: int = 0
 
 
 @dataclass
@@ -24,6 +26,22 @@ class Output:
     min_port: int
     max_port: int
     interface_ip: str
+    state: Optional[str] = None
+    metrics: Optional[str] = None
+
+
+@dataclass
+class Execution:
+    forks: int = 5
+    strategy: str = 'free'
+    serial: Optional[int] = None
+    pipelining: bool = False
+    control_persist: Optional[str] = None
+    executor: str = 'auto'
+    inventory_cache_ttl: Optional[int] = None
+    rolling_batch_size: int = 1
+    health_timeout: int = 300
+    teardown_workers: int = 4
 
 
 @dataclass
@@ -37,18 +55,23 @@ class Config:
     boxes: list[Box]
     inventory: Optional[str] = None
     registry: Optional[str] = None
+    execution: Execution = field(default_factory=Execution)
+    pool_size: int = 0
+    placement: str = 'least-loaded'
 
 
 def load_config(file_path: str) -> Config:
     with open(file_path, 'r') as file:
-        data = yaml.safe_load(file)
+        data = yaml_lib.load(file)
         return Config(
             version=data['version'],
             output=Output(
                 backend_map=data['output']['backend_map'],
                 min_port=data['output']['min_port'],
                 max_port=data['output']['max_port'],
-                interface_ip=data['output']['interface_ip']
+                interface_ip=data['output']['interface_ip'],
+                state=data['output'].get('state'),
+                metrics=data['output'].get('metrics')
             ),
             target=data['target'],
             lb_endpoint=data['lb_endpoint'],
@@ -56,7 +79,12 @@ def load_config(file_path: str) -> Config:
             stop_command=data['stop_command'],
             boxes=[Box(name=box['name'],
                        services=[Service(**service) for service in
-                                 box['services']]) for box in data['boxes']],
+                                 box['services']],
+                       cpus=box.get('cpus', 0),
+                       memory=box.get('memory', 0)) for box in data['boxes']],
             inventory=data.get('inventory'),
-            registry=data.get('registry')
+            registry=data.get('registry'),
+            execution=Execution(**(data.get('execution') or {})),
+            pool_size=data.get('pool_size', 0),
+            placement=data.get('placement', 'least-loaded')
         )
@@ -1,14 +1,24 @@
 import argparse
 import logging
 import subprocess
+import sys
+import time
 from pathlib import Path
 
 from docker_deploy import backend_map_lib, registry
+from docker_deploy import cache_lib
 from docker_deploy import config_lib
 from docker_deploy import docker
-from docker_deploy.ansible_deploy import Play, Playbook, get_hostnames, \
-    next_hostname, get_host_for_instance
-from docker_deploy.ansible_deploy.task import Copy
+from docker_deploy import health_lib
+from docker_deploy import metrics_lib
+from docker_deploy import pool_lib
+from docker_deploy import reload_lib
+from docker_deploy import scheduler_lib
+from docker_deploy import state_lib
+from docker_deploy.port_lib import PortAllocator
+from docker_deploy.ansible_deploy import Play, Playbook, get_hosts, \
+    get_host_for_instance, batch_by_host, instance_hosts
+from docker_deploy.ansible_deploy.task import Sync
 
 # Set up logging
 logging.basicConfig(filename='deploy.log', level=logging.INFO,
@@ -17,58 +27,97 @@ logging.basicConfig(filename='deploy.log', level=logging.INFO,
 
 # TODO fix logging to be relvent with ansible system
 
+READ_ONLY_COMMANDS = {'ids', 'show', 'ports', 'hosts'}
+DEPLOYING_COMMANDS = {'deploy', 'scale', 'pool'}
+
+
+def compose_source(config: config_lib.Config
+                   ) -> (str, list[registry.Buildable]):
+    # The compose file with its images mirrored or built. This can take
+    # minutes, so it is done before the state lock is taken.
+    with open(Path(config.target) / 'docker-compose.yml', 'r') as file:
+        docker_file = file.read()
+
+    buildables = []
+    with metrics_lib.span('registry'):
+        if config.registry is not None:
+            docker_file = registry.build(docker_file, config.registry,
+                                         config.target)
+        else:
+            docker_file, buildables = registry.prebuild(docker_file,
+                                                        config.target)
+    return docker_file, buildables
+
 
 def deploy_instances(
         count: int,
         backend_map: backend_map_lib.BackendMap,
-        config: config_lib.Config
+        config: config_lib.Config,
+        min_instance_id: int = 1,
+        possible_hosts: dict[str, dict] | None = None,
+        reserved: backend_map_lib.BackendMap | None = None,
+        placement: list[str] | None = None,
+        held_ports: set[int] | None = None,
+        source: tuple[str, list[registry.Buildable]] | None = None
 ) -> (backend_map_lib.BackendMap, list[Play]):
     plays = []
-    possible_hosts = get_hostnames(config.inventory)
+    if possible_hosts is None:
+        possible_hosts = get_hosts(config.inventory)
+    neighbours = [backend_map] if reserved is None else [backend_map, reserved]
 
     logging.info(f'Deploying {count} instances.')
 
-    next_instance_id = max(
-        [int(instance.id) for instance in backend_map.backends] + [0]) + 1
-    next_free_port = config.output.min_port
-    required_ports = 0
-
-    for box in config.boxes:
-        required_ports += len(box.services)
-
-    for instance in backend_map.backends:
-        for service in instance.services:
-            port = int(service.host.split(':')[1])
-            next_free_port = max(next_free_port, port + 1)
-
-    with open(Path(config.target) / 'docker-compose.yml', 'r') as file:
-        docker_file = file.read()
+    next_instance_id = max(backend_map.next_instance_id(), min_instance_id)
+    required_ports = docker.no_ports_required(config.boxes)
 
-    if config.registry is not None:
-        docker_file = registry.build(docker_file, config.registry,
-                                     config.target)
+    port_allocator = PortAllocator(
+        config.output.min_port,
+        config.output.max_port,
+        backend_map.used_ports() |
+        (set() if reserved is None else reserved.used_ports()) |
+        (held_ports or set())
+    )
+    start_ports = port_allocator.allocate_many(count, required_ports)
+    if placement is None:
+        scheduler = scheduler_lib.Scheduler(possible_hosts, config.boxes,
+                                            config.placement)
+        placement = [decision.host
+                     for decision in scheduler.place(count, neighbours)]
+
+    if source is None:
+        source = compose_source(config)
+    docker_file, buildables = source
+    with metrics_lib.span('compose_render'):
+        template = docker.ComposeTemplate(docker_file, backend_map.layout,
+                                          config.boxes, config.target)
+        for start_port, target_host in zip(start_ports, placement):
+            # logging.info(f'Starting deployment of instance {next_instance_id}.')
+            logging.info(
+                f'Building playbook to deploy instance {next_instance_id}.')
+            logging.info(
+                f'Placed instance {next_instance_id} on {target_host}.')
+            map_instance, tasks = docker.create_deployment(
+                template,
+                next_instance_id,
+                start_port,
+                target_host
+            )
+            tasks.extend(docker.start_deployment(int(map_instance.id)))
+            backend_map.add_instance(map_instance)
+            next_instance_id += 1
+            plays.append(Play(
+                name=f'Deploy Instance {map_instance.id}',
+                tasks=tasks,
+                hosts=[target_host],
+                instance_id=map_instance.id
+            ))
 
-    for _ in range(count):
-        # logging.info(f'Starting deployment of instance {next_instance_id}.')
-        logging.info(
-            f'Building playbook to deploy instance {next_instance_id}.')
-        map_instance, tasks = docker.create_deployment(
-            config,
-            backend_map,
-            docker_file,
-            next_instance_id,
-            next_free_port,
-            next_hostname(possible_hosts, backend_map.backends)
-        )
-        tasks.extend(docker.start_deployment(int(map_instance.id)))
-        backend_map.backends.append(map_instance)
-        next_instance_id += 1
-        next_free_port += required_ports
-        target_host = next_hostname(possible_hosts, backend_map.backends)
-        plays.append(Play(
-            name=f'Deploy Instance {map_instance.id}',
-            tasks=tasks,
-            hosts=[target_host]
+    hosts = list(dict.fromkeys(play['hosts'][0] for play in plays))
+    if len(buildables) > 0 and len(hosts) > 0:
+        plays.insert(0, Play(
+            name='Build Images',
+            tasks=docker.build_images(buildables),
+            hosts=hosts
         ))
 
     # logging.info(f'Completed deployment of {count} instances.')
@@ -77,89 +126,172 @@ def deploy_instances(
 
 def destroy_instance(
         instance_id,
-        instances: list[backend_map_lib.Instance]
-) -> (list[backend_map_lib.Instance], list[Play]):
-    instance_index = get_instance_index(instance_id, instances)
-
-    if instance_index is None:
+        backend_map: backend_map_lib.BackendMap
+) -> (backend_map_lib.BackendMap, list[Play]):
+    if backend_map.get_instance(instance_id) is None:
         logging.error(f'Instance {instance_id} does not exist.')
-        return instances, []
+        return backend_map, []
 
     logging.info(f'Destroying instance {instance_id}.')
 
     plays = [Play(
         name=f'Destroy Instance {instance_id}',
         tasks=docker.delete_deployment(instance_id),
-        hosts=[get_host_for_instance(instance_id, instances)]
+        hosts=[get_host_for_instance(instance_id, backend_map)],
+        instance_id=instance_id
     )]
 
-    instances.pop(instance_index)
+    backend_map.remove_instance(instance_id)
 
-    return instances, plays
+    return backend_map, plays
 
 
-def get_instance_index(instance_id, instances):
-    instance_index = None
-    for i in range(len(instances)):
-        if instances[i].id == instance_id:
-            instance_index = i
-            break
-    return instance_index
+def scale_instances(
+        count: int,
+        per_host: bool,
+        backend_map: backend_map_lib.BackendMap,
+        pool: backend_map_lib.BackendMap,
+        config: config_lib.Config,
+        min_instance_id: int,
+        possible_hosts: dict[str, dict],
+        held_ports: set[int] | None = None,
+        source: tuple[str, list[registry.Buildable]] | None = None
+) -> (backend_map_lib.BackendMap, list[Play]):
+    # Works out how many instances each host should run and only creates or
+    # deletes the difference. Moving an instance is a delete on a host with
+    # too many and a create on one with too few, all in one playbook.
+    hosts_by_address = {scheduler_lib.address(host): host
+                         for host in possible_hosts}
+    instances_by_host: dict[str, list[str]] = {}
+    for instance in backend_map.backends:
+        address = get_host_for_instance(instance.id, backend_map)
+        instances_by_host.setdefault(
+            hosts_by_address.get(address, address), []).append(instance.id)
+    current = {host: len(instance_ids)
+               for host, instance_ids in instances_by_host.items()}
+
+    scheduler = scheduler_lib.Scheduler(possible_hosts, config.boxes,
+                                        config.placement)
+    if per_host:
+        for host in possible_hosts:
+            if not scheduler.fits(host, count):
+                raise ValueError(f"{host} has no capacity for {count} "
+                                 f"instances")
+        target = {host: count for host in possible_hosts}
+    else:
+        target = scheduler.spread(count, current)
+
+    creates = {host: target[host] - current.get(host, 0) for host in target
+               if target[host] > current.get(host, 0)}
+    # Hosts that left the inventory keep no instances.
+    deletes = {host: current[host] - target.get(host, 0) for host in current
+               if current[host] > target.get(host, 0)}
+    logging.info(f'Scaling from {len(backend_map.backends)} to '
+                 f'{sum(target.values())} instances: '
+                 f'{sum(creates.values())} to create, '
+                 f'{sum(deletes.values())} to delete.')
+    print(f'Scaling from {len(backend_map.backends)} to '
+          f'{sum(target.values())} instances: '
+          f'+{sum(creates.values())} -{sum(deletes.values())}')
 
+    plays = []
+    placement = []
+    for host, missing in creates.items():
+        promoted = pool_lib.promote(missing, pool, backend_map, [host])
+        placement.extend([host] * (missing - len(promoted)))
+    if len(placement) > 0:
+        plays.append(init_play(config))
+        # Created before the deletes are applied, so no port of an instance
+        # that is still being torn down is handed out again.
+        backend_map, deploy_plays = deploy_instances(
+            len(placement), backend_map, config, min_instance_id,
+            possible_hosts, pool, placement, held_ports, source)
+        plays.extend(deploy_plays)
 
-def destroy_all(instances) -> list[Play]:
+    for host, surplus in deletes.items():
+        # The newest instances go first.
+        for instance_id in sorted(instances_by_host[host], key=int,
+                                  reverse=True)[:surplus]:
+            backend_map, destroy_plays = destroy_instance(instance_id,
+                                                          backend_map)
+            plays.extend(destroy_plays)
+
+    return backend_map, plays
+
+
+def destroy_all(backend_maps: list[backend_map_lib.BackendMap],
+                workers: int) -> list[Play]:
     logging.info('Destroying all instances.')
 
-    instance_ids = [instance.id for instance in instances]
+    instances_by_host: dict[str, list[str]] = {}
+    for backend_map in backend_maps:
+        for instance in backend_map.backends:
+            host = get_host_for_instance(instance.id, backend_map)
+            instances_by_host.setdefault(host, []).append(instance.id)
 
     plays = []
 
-    for instance_id in instance_ids:
-        logging.info(f'Starting destruction of instance {instance_id}.')
+    for host, instance_ids in instances_by_host.items():
+        logging.info(f'Tearing down {len(instance_ids)} instances on {host}.')
 
         plays.append(Play(
-            name=f'Destroy Instance {instance_id}',
-            tasks=docker.delete_deployment(instance_id),
-            hosts=[get_host_for_instance(instance_id, instances)]
+            name=f'Destroy {len(instance_ids)} instances on {host}',
+            tasks=docker.teardown_deployments(instance_ids, workers),
+            hosts=[host]
         ))
 
-    logging.info(f'Completed destruction of all {len(instance_ids)} instances.')
+    logging.info(f'Planned destruction of all '
+                 f'{sum(map(len, instances_by_host.values()))} instances.')
 
     return plays
 
 
-def restart_instance(instance_id, instances) -> list[Play]:
-    instance_index = get_instance_index(instance_id, instances)
-
-    if instance_index is None:
+def restart_instance(instance_id,
+                     backend_map: backend_map_lib.BackendMap,
+                     reset: bool = False,
+                     boxes: list[str] | None = None) -> list[Play]:
+    if backend_map.get_instance(instance_id) is None:
         logging.error(f'Instance {instance_id} does not exist.')
         return []
 
+    if reset or boxes:
+        logging.info(f'Resetting instance {instance_id}.')
+        return [Play(
+            name=f'Reset Instance {instance_id}',
+            tasks=docker.reset_deployment(instance_id, boxes),
+            hosts=[get_host_for_instance(instance_id, backend_map)],
+            instance_id=instance_id
+        )]
+
     logging.info(f'Restarting instance {instance_id}.')
+    # `down` already removes the containers. The instance directory holds
+    # its compose file, so it has to stay for `up`.
     tasks = []
     tasks.extend(docker.stop_deployment(instance_id))
-    tasks.extend(docker.delete_deployment(instance_id))
     tasks.extend(docker.start_deployment(instance_id))
 
     plays = [
         Play(
             name=f'Stop Instance {instance_id}',
             tasks=tasks,
-            hosts=[get_host_for_instance(instance_id, instances)]
+            hosts=[get_host_for_instance(instance_id, backend_map)],
+            instance_id=instance_id
         )
     ]
 
     return plays
 
 
-def restart_all(instances) -> list[Play]:
+def restart_all(backend_map: backend_map_lib.BackendMap,
+                reset: bool = False,
+                boxes: list[str] | None = None) -> list[Play]:
     logging.info('Restarting all instances.')
     plays = []
-    instance_ids = [instance.id for instance in instances]
+    instance_ids = [instance.id for instance in backend_map.backends]
 
     for instance_id in instance_ids:
         logging.info(f'Starting restart of instance {instance_id}.')
-        plays.extend(restart_instance(instance_id, instances))
+        plays.extend(restart_instance(instance_id, backend_map, reset, boxes))
 
     return plays
 
@@ -177,8 +309,65 @@ def print_ids(instances: list[backend_map_lib.Instance]) -> None:
         print(instance.id)
 
 
+def print_instance(instance_id,
+                   backend_map: backend_map_lib.BackendMap) -> bool:
+    instance = backend_map.get_instance(instance_id)
+    if instance is None:
+        print(f'Instance {instance_id} does not exist.', file=sys.stderr)
+        return False
+    for service in instance.services:
+        print(f'{service.box_id} {service.service_id} {service.host}')
+    return True
+
+
+def print_ports(instances: list[backend_map_lib.Instance]) -> None:
+    ports = []
+    for instance in instances:
+        for service in instance.services:
+            ports.append((int(service.host.split(':')[1]), service.host,
+                          instance.id, service.box_id, service.service_id))
+    for _, host, instance_id, box_id, service_id in sorted(ports):
+        print(f'{host} {instance_id} {box_id} {service_id}')
+
+
+def print_hosts(backend_map: backend_map_lib.BackendMap) -> None:
+    hosts = {host for instance in backend_map.backends
+             for host in instance.hosts()}
+    for host in sorted(hosts):
+        print(f'{host} {len(backend_map.instance_ids_on_host(host))} '
+              f'{backend_map.service_count(host)}')
+
+
+def print_placement(count: int, config: config_lib.Config,
+                    hosts: dict[str, dict],
+                    backend_maps: list[backend_map_lib.BackendMap]):
+    scheduler = scheduler_lib.Scheduler(hosts, config.boxes,
+                                        config.placement)
+    for number, decision in enumerate(scheduler.place(count, backend_maps),
+                                      start=1):
+        print(f'{number} {decision.host} {decision.instances} '
+              f'{decision.load:.2f}')
+
+
+def query(args, backend_map: backend_map_lib.BackendMap) -> int:
+    if args.command == 'ids':
+        print_ids(backend_map.backends)
+    elif args.command == 'show':
+        if not print_instance(args.target, backend_map):
+            return 1
+    elif args.command == 'ports':
+        print_ports(backend_map.backends)
+    elif args.command == 'hosts':
+        print_hosts(backend_map)
+    return 0
+
+
 def main():
-    config = config_lib.load_config('config.yml')
+    # The arguments depend on the config, and only some commands need the
+    # inventory hosts, which are resolved once the command is known.
+    with metrics_lib.span('config'):
+        snapshot = cache_lib.load_snapshot('config.yml', with_hosts=False)
+    config = snapshot.config
 
     parser = argparse.ArgumentParser(description='Deploy and manage instances.')
 
@@ -188,6 +377,18 @@ def main():
     deploy_parser = subparsers.add_parser('deploy', help='Deploy instances')
     deploy_parser.add_argument('count', type=int,
                                help='Number of instances to deploy')
+    deploy_parser.add_argument('--dry-run', action='store_true',
+                               help='Print where new instances would be '
+                                    'placed without deploying them')
+
+    # Scale command
+    scale_parser = subparsers.add_parser(
+        'scale', help='Create or delete instances until there are exactly '
+                      'count of them')
+    scale_parser.add_argument('count', type=int,
+                              help='Number of instances to run')
+    scale_parser.add_argument('--per-host', action='store_true',
+                              help='Run count instances on every host')
 
     # Destroy command
     destroy_parser = subparsers.add_parser('destroy', help='Destroy instances')
@@ -200,51 +401,335 @@ def main():
     restart_parser.add_argument('target',
                                 help='Instance ID or "all" to restart all '
                                      'instances')
-
-    # List ids command
+    restart_parser.add_argument('--reset', action='store_true',
+                                help='Recreate the containers from the '
+                                     'existing images instead of rebuilding')
+    restart_parser.add_argument('--rolling', action='store_true',
+                                help='Restart in batches, waiting for each '
+                                     'batch to accept connections')
+    restart_parser.add_argument('--batch-size', type=int,
+                                default=config.execution.rolling_batch_size,
+                                help='Instances per batch with --rolling')
+    restart_parser.add_argument('--box', action='append', dest='boxes',
+                                choices=[box.name for box in config.boxes],
+                                help='Only reset this box (implies --reset, '
+                                     'can be repeated)')
+
+    # Pool command
+    pool_parser = subparsers.add_parser(
+        'pool', help='Manage the pool of warm standby instances')
+    pool_parser.add_argument('action', choices=['fill'],
+                             help='"fill" starts instances until every host '
+                                  'has pool_size of them')
+
+    # Read-only commands
     subparsers.add_parser('ids', help='List all instance IDs')
+    show_parser = subparsers.add_parser(
+        'show', help='List the services of an instance')
+    show_parser.add_argument('target', help='Instance ID')
+    subparsers.add_parser('ports', help='List all ports in use')
+    subparsers.add_parser(
+        'hosts', help='List the instance and service count of each host')
 
     args = parser.parse_args()
 
-    plays: list[Play] = []
+    # Queries only read the backend map: no lock, no playbook and no
+    # launch command.
+    if args.command in READ_ONLY_COMMANDS:
+        _, backend_map = load_state(config, snapshot.layout)
+        sys.exit(query(args, backend_map))
+
+    with metrics_lib.span('config'):
+        snapshot = cache_lib.load_snapshot('config.yml')
+    config = snapshot.config
+
+    if args.command == 'deploy' and args.dry_run:
+        _, backend_map = load_state(config, snapshot.layout)
+        pool = pool_lib.load_pool(config.output.backend_map, backend_map)
+        print_placement(args.count, config, snapshot.hosts,
+                        [backend_map, pool])
+        return
+
+    try:
+        sys.exit(run_command(args, config, snapshot))
+    finally:
+        metrics_lib.export(config.output.metrics, args.command)
+
+
+def run_command(args, config: config_lib.Config,
+                snapshot: cache_lib.Snapshot) -> int:
+    # Hold the state lock only while reading, planning and saving the
+    # backend map. The images are prepared before it and the playbook runs
+    # after it, so concurrent commands only queue behind each other's
+    # planning.
+    source = None
+    if args.command in DEPLOYING_COMMANDS:
+        source = compose_source(config)
+
+    lock_file = config.output.backend_map + '.lock'
+    with state_lib.StateLock(lock_file) as lock:
+        with metrics_lib.span('backend_map_load'):
+            store, backend_map = load_state(config, snapshot.layout)
+            pool = pool_lib.load_pool(config.output.backend_map, backend_map)
+        pool_ids = {instance.id for instance in pool.backends}
+        if args.command == 'pool':
+            # Standbys another fill is still starting count as in the pool,
+            # so the hosts are not filled twice.
+            for instance in lock.pending():
+                pool.add_instance(instance)
+        used_ports = backend_map.used_ports() | pool.used_ports()
+        with metrics_lib.span('plan'):
+            plays, is_destroying_all = plan(args, config, backend_map, pool,
+                                            lock.last_instance_id() + 1,
+                                            snapshot.hosts,
+                                            lock.held_ports(), source)
+        lock.set_last_instance_id(max(lock.last_instance_id(),
+                                      backend_map.next_instance_id() - 1,
+                                      pool.next_instance_id() - 1))
+        # Ports of destroyed instances stay taken until their containers
+        # are gone, which is only after the playbook.
+        freed_ports = used_ports - backend_map.used_ports() - \
+            pool.used_ports()
+        # New standbys join the pool only once they are running, so no
+        # concurrent deploy promotes one that never started. Until then
+        # they are pending in the lock file and their ports are held like
+        # freed ones.
+        standbys = []
+        if args.command == 'pool':
+            pending_ids = {instance.id for instance in lock.pending()}
+            for instance in list(pool.backends):
+                if instance.id in pool_ids:
+                    continue
+                pool.remove_instance(instance.id)
+                if instance.id not in pending_ids:
+                    standbys.append(instance)
+            pool.pending_changes().clear()
+        held_ports = freed_ports | {port for standby in standbys
+                                    for port in standby.ports()}
+        lock.hold_ports(held_ports)
+        lock.add_pending(standbys)
+
+        with metrics_lib.span('backend_map_save'):
+            if store is not None:
+                store.commit(backend_map)
+            map_changed = backend_map_lib.write_backend_map(
+                backend_map, config.output.backend_map)
+            pool_lib.save_pool(pool, config.output.backend_map)
+
+    failed = None
+    try:
+        with metrics_lib.span('execution'):
+            if args.command == 'restart' and args.rolling:
+                ok = rolling_restart(plays, backend_map, config,
+                                     args.batch_size)
+            else:
+                report = Playbook(batch_by_host(plays)).run(
+                    config.inventory, config.execution)
+                failed = report.failed_instances(instance_hosts(plays))
+                ok = report_failures(failed)
+    finally:
+        if held_ports or standbys:
+            with state_lib.StateLock(lock_file) as lock:
+                if standbys and failed is not None:
+                    add_standbys(standbys, failed, config, snapshot.layout)
+                lock.remove_pending({standby.id for standby in standbys})
+                lock.release_ports(held_ports)
+
+    if map_changed:
+        with metrics_lib.span('lb_relaunch'):
+            reload_lib.request_reload(config.launch_command,
+                                      config.output.backend_map)
+
+    if args.command in ('deploy', 'scale') and config.pool_size > 0:
+        pool_lib.refill_in_background()
+
+    if is_destroying_all:
+        with metrics_lib.span('stop_command'):
+            subprocess.run(config.stop_command["command"],
+                           cwd=config.stop_command["context"],
+                           shell=True, check=True)
+        logging.info(f"Ran stop command: {config.stop_command}")
 
-    backend_map = backend_map_lib.build_backend_map_base(
-        config.output.backend_map,
-        config.lb_endpoint,
-        config.boxes
+    return 0 if ok else 1
+
+
+def add_standbys(standbys: list[backend_map_lib.Instance], failed: set[str],
+                 config: config_lib.Config,
+                 layout: list[backend_map_lib.Box] | None = None):
+    # Called under the state lock once the fill playbook is done. The pool
+    # is read again, as other commands may have promoted from it meanwhile.
+    _, backend_map = load_state(config, layout)
+    pool = pool_lib.load_pool(config.output.backend_map, backend_map)
+    for standby in standbys:
+        if standby.id not in failed:
+            pool.add_instance(standby)
+    pool_lib.save_pool(pool, config.output.backend_map)
+
+
+def report_failures(failed: set[str]) -> bool:
+    if len(failed) == 0:
+        return True
+    instance_ids = ", ".join(sorted(failed, key=int))
+    logging.error(f'Instances failed: {instance_ids}')
+    print(f'Instances failed: {instance_ids}')
+    return False
+
+
+def load_state(
+        config: config_lib.Config,
+        layout: list[backend_map_lib.Box] | None = None
+) -> (state_lib.JournalStore | None, backend_map_lib.BackendMap):
+    store = None
+    backend_map = None
+    if config.output.state is not None:
+        store = state_lib.JournalStore(config.output.state)
+        backend_map = store.load()
+    if backend_map is None:
+        backend_map = backend_map_lib.build_backend_map_base(
+            config.output.backend_map,
+            config.lb_endpoint,
+            config.boxes,
+            layout
+        )
+    return store, backend_map
+
+
+def rolling_restart(plays: list[Play],
+                    backend_map: backend_map_lib.BackendMap,
+                    config: config_lib.Config,
+                    batch_size: int) -> bool:
+    batch_size = max(batch_size, 1)
+    batches = [plays[i:i + batch_size]
+               for i in range(0, len(plays), batch_size)]
+    logging.info(f'Rolling restart of {len(plays)} instances in '
+                 f'{len(batches)} batches of up to {batch_size}.')
+    rollout_start = time.perf_counter()
+
+    for number, batch in enumerate(batches, start=1):
+        batch_start = time.perf_counter()
+        report = Playbook(batch_by_host(batch)).run(config.inventory,
+                                                    config.execution)
+        if not report_failures(report.failed_instances(
+                instance_hosts(batch))):
+            logging.error(f'Batch {number}/{len(batches)} failed. '
+                          f'Stopping rollout.')
+            return False
+        endpoints = [service.host
+                     for play in batch
+                     for service in backend_map.get_instance(
+                         play['instance_id']).services]
+        unhealthy = health_lib.wait_for_endpoints(
+            endpoints, config.execution.health_timeout)
+        elapsed = time.perf_counter() - batch_start
+        instance_ids = ", ".join(play['instance_id'] for play in batch)
+
+        if len(unhealthy) > 0:
+            logging.error(f'Batch {number}/{len(batches)} (instances '
+                          f'{instance_ids}) not healthy after {elapsed:.1f}s: '
+                          f'{", ".join(unhealthy)}. Stopping rollout.')
+            print(f'Batch {number}/{len(batches)} failed after '
+                  f'{elapsed:.1f}s: {", ".join(unhealthy)} not reachable')
+            return False
+
+        logging.info(f'Batch {number}/{len(batches)} (instances '
+                     f'{instance_ids}) healthy after {elapsed:.1f}s.')
+        print(f'Batch {number}/{len(batches)}: {elapsed:.1f}s')
+
+    total = time.perf_counter() - rollout_start
+    logging.info(f'Rolling restart completed in {total:.1f}s.')
+    print(f'Rolling restart completed in {total:.1f}s')
+    return True
+
+
+def init_play(config: config_lib.Config) -> Play:
+    return Play(
+        name='Init Deploy Dir',
+        tasks=[
+            docker.init_deployment_dir(),
+            Sync(
+                name="Sync docker dir to deploy dir",
+                src=config.target,
+                dest=str(docker.SHARED_DIR)
+            )
+        ],
+        hosts=['all'] if config.inventory is not None else ['localhost']
     )
 
+
+def plan(args, config: config_lib.Config,
+         backend_map: backend_map_lib.BackendMap,
+         pool: backend_map_lib.BackendMap,
+         min_instance_id: int,
+         possible_hosts: dict[str, dict] | None = None,
+         held_ports: set[int] | None = None,
+         source: tuple[str, list[registry.Buildable]] | None = None
+         ) -> (list[Play], bool):
+    plays: list[Play] = []
     is_destroying_all = False
+    if possible_hosts is None:
+        possible_hosts = get_hosts(config.inventory)
+    min_instance_id = max(min_instance_id, backend_map.next_instance_id(),
+                          pool.next_instance_id())
 
     if args.command == 'deploy':
-        if len(backend_map.backends) == 0:
-            plays.append(Play(
-                name='Init Deploy Dir',
-                tasks=[
-                    docker.init_deployment_dir(),
-                    Copy(
-                        name="Copy docker dir to deploy dir",
-                        src=config.target,
-                        dest="/home/{{ansible_user}}/deployments/docker"
-                    )
-                ],
-                hosts=['all'] if config.inventory is not None else ['localhost']
-            ))
-        backend_map, deploy_plays = deploy_instances(
+        promoted = pool_lib.promote(args.count, pool, backend_map,
+                                    possible_hosts)
+        if len(promoted) < args.count:
+            plays.append(init_play(config))
+            backend_map, deploy_plays = deploy_instances(
+                args.count - len(promoted),
+                backend_map,
+                config,
+                min_instance_id,
+                possible_hosts,
+                pool,
+                held_ports=held_ports,
+                source=source
+            )
+            plays.extend(deploy_plays)
+
+    elif args.command == 'scale':
+        backend_map, scale_plays = scale_instances(
             args.count,
+            args.per_host,
             backend_map,
-            config
+            pool,
+            config,
+            min_instance_id,
+            possible_hosts,
+            held_ports,
+            source
         )
-        plays.extend(deploy_plays)
+        plays.extend(scale_plays)
+
+    elif args.command == 'pool':
+        missing = pool_lib.missing(pool, possible_hosts, config.pool_size)
+        if len(missing) > 0:
+            plays.append(init_play(config))
+            pool, pool_plays = deploy_instances(
+                sum(missing.values()),
+                pool,
+                config,
+                min_instance_id,
+                {host: possible_hosts[host] for host in missing},
+                backend_map,
+                [host for host, count in missing.items()
+                 for _ in range(count)],
+                held_ports,
+                source
+            )
+            plays.extend(pool_plays)
 
     elif args.command == 'destroy':
         if args.target == 'all':
-            destroy_plays = destroy_all(backend_map.backends)
-            backend_map.backends = []
+            destroy_plays = destroy_all([backend_map, pool],
+                                        config.execution.teardown_workers)
+            backend_map.clear()
+            pool.clear()
         else:
-            backend_map.backends, destroy_plays = destroy_instance(
+            backend_map, destroy_plays = destroy_instance(
                 args.target,
-                backend_map.backends
+                backend_map
             )
 
         plays.extend(destroy_plays)
@@ -254,27 +739,13 @@ def main():
 
     elif args.command == 'restart':
         if args.target == 'all':
-            restart_plays = restart_all(backend_map.backends)
+            restart_plays = restart_all(backend_map, args.reset, args.boxes)
         else:
-            restart_plays = restart_instance(args.target, backend_map.backends)
+            restart_plays = restart_instance(args.target, backend_map,
+                                             args.reset, args.boxes)
         plays.extend(restart_plays)
 
-    elif args.command == 'ids':
-        print_ids(backend_map.backends)
-
-    Playbook(plays).run(config.inventory)
-
-    backend_map_lib.save_backend_map(
-        backend_map,
-        config.output.backend_map,
-        config.launch_command
-    )
-
-    if is_destroying_all:
-        subprocess.run(config.stop_command["command"],
-                       cwd=config.stop_command["context"],
-                       shell=True, check=True)
-        logging.info(f"Ran stop command: {config.stop_command}")
+    return plays, is_destroying_all
 
 
 if __name__ == '__main__':
@@ -1,15 +1,20 @@
 # import shutil
 # import subprocess
+import posixpath
+import re
+import shlex
+import time
 from pathlib import Path
 
-import yaml
-
 from docker_deploy import backend_map_lib
 from docker_deploy import config_lib
+from docker_deploy import registry
+from docker_deploy import yaml_lib
 from docker_deploy.ansible_deploy.task import Mkdir, Task, WriteFile, \
-    DockerCompose, Rm, LocalCopy
+    DockerCompose, Rm, LocalCopy, Shell
 
 DEPLOY_DIR = Path("deployments")
+SHARED_DIR = "/home/{{ansible_user}}" / DEPLOY_DIR / "docker"
 
 
 def init_deployment_dir() -> Task:
@@ -130,41 +135,161 @@ def adapt_docker_compose(
     return docker_file, instance_services
 
 
+def is_relative_path(path) -> bool:
+    return isinstance(path, str) and not path.startswith(('/', '~')) and \
+        '://' not in path and not path.startswith('git@')
+
+
+def share_context(compose: dict, shared_dir: str) -> bool:
+    # Points build contexts, env files, configs and secrets at the shared
+    # copy of the target, so an instance directory only needs its
+    # docker-compose.yml. Returns False when a service bind mounts a
+    # relative path, as instances must not share that data.
+    def shared(path: str) -> str:
+        return posixpath.normpath(posixpath.join(shared_dir, path))
+
+    for service in compose.get('services', {}).values():
+        build = service.get('build')
+        if is_relative_path(build):
+            service['build'] = shared(build)
+        elif isinstance(build, dict) and \
+                is_relative_path(build.get('context', '.')):
+            build['context'] = shared(build.get('context', '.'))
+
+        env_files = service.get('env_file')
+        if isinstance(env_files, (str, dict)):
+            env_files = service['env_file'] = [env_files]
+        for index, env_file in enumerate(env_files or []):
+            if isinstance(env_file, dict):
+                env_file['path'] = shared(env_file['path'])
+            else:
+                env_files[index] = shared(env_file)
+
+        extends = service.get('extends')
+        if isinstance(extends, dict) and is_relative_path(extends.get('file')):
+            extends['file'] = shared(extends['file'])
+
+        for volume in service.get('volumes', []):
+            source = volume.split(':')[0] if isinstance(volume, str) else \
+                volume.get('source') if volume.get('type') == 'bind' else None
+            if isinstance(source, str) and source.startswith('.'):
+                return False
+
+    for section in ('configs', 'secrets'):
+        for definition in (compose.get(section) or {}).values():
+            if isinstance(definition, dict) and \
+                    is_relative_path(definition.get('file')):
+                definition['file'] = shared(definition['file'])
+    return True
+
+
+class ComposeTemplate:
+    # The compose file parsed and rewritten once per deploy. Every published
+    # port is left as a placeholder, so rendering an instance is a single
+    # string substitution rather than a YAML load/adapt/dump round trip.
+
+    PLACEHOLDER = re.compile(r'__docker_deploy_port_(\d+)__')
+
+    def __init__(self, docker_file: str,
+                 backend_boxes: list[backend_map_lib.Box],
+                 config_boxes: list[config_lib.Box],
+                 target: str | None = None):
+        compose = strip_docker_ports(yaml_lib.load(docker_file))
+        # Without relative bind mounts an instance directory holds only the
+        # generated compose file (and .env, which compose reads from the
+        # project directory); otherwise the whole target is copied.
+        self.shared = share_context(compose, str(SHARED_DIR))
+        self.env_file = target is not None and \
+            (Path(target) / '.env').is_file()
+        # (box id, service id, container port) per port slot, in the order
+        # the instance's ports are allocated.
+        self.slots: list[tuple[str, str, int]] = []
+        for config_box in config_boxes:
+            box_id = get_box_id(backend_boxes, config_box)
+            ports = compose["services"][config_box.name].setdefault(
+                "ports", [])
+            for service in config_box.services:
+                ports.append(f"__docker_deploy_port_{len(self.slots)}__")
+                self.slots.append((
+                    box_id,
+                    get_service_id(backend_boxes, service, box_id),
+                    service.port
+                ))
+        self.text = yaml_lib.dump(compose)
+
+    def render(
+            self, start_port: int, interface: str
+    ) -> (str, list[backend_map_lib.ServiceInstance]):
+        def port_mapping(match: re.Match) -> str:
+            slot = int(match.group(1))
+            return (f"'{interface}:{start_port + slot}:"
+                    f"{self.slots[slot][2]}'")
+
+        instance_services = [
+            backend_map_lib.ServiceInstance(
+                box_id=box_id,
+                service_id=service_id,
+                host=f"{interface}:{start_port + slot}",
+            )
+            for slot, (box_id, service_id, _) in enumerate(self.slots)
+        ]
+        return self.PLACEHOLDER.sub(port_mapping, self.text), \
+            instance_services
+
+
+def build_images(buildables: list[registry.Buildable]) -> list[Task]:
+    tasks = []
+    for buildable in buildables:
+        build = shlex.join(buildable.build_command(
+            labels={'docker_deploy.content_key': buildable.key}
+        ))
+        tasks.append(Shell(
+            name=f"Build {buildable.tag}",
+            cmd=f"docker image inspect {shlex.quote(buildable.tag)} "
+                f"> /dev/null 2>&1 || {build}",
+            chdir=str(SHARED_DIR / buildable.context)
+        ))
+    return tasks
+
+
 def create_deployment(
-        config: config_lib.Config,
-        backend_map: backend_map_lib.BackendMap,
-        docker_file: str,
+        template: ComposeTemplate,
         instance_id: int,
         start_port: int,
         deploy_host: str
 ) -> (backend_map_lib.Instance, list[Task]):
     tasks = []
-    docker_file = yaml.safe_load(docker_file)
 
     target_dir = "/home/{{ansible_user}}" / DEPLOY_DIR / str(instance_id)
 
-    tasks.append(LocalCopy(
-        name="Copy target directory",
-        src="/home/{{ansible_user}}/deployments/docker",
-        dest=str(target_dir),
-        is_dir=True
-    ))
+    if template.shared:
+        tasks.append(Mkdir(
+            name="Create deployment directory",
+            path=str(target_dir)
+        ))
+        if template.env_file:
+            tasks.append(LocalCopy(
+                name="Copy .env",
+                src=str(SHARED_DIR / '.env'),
+                dest=str(target_dir / '.env')
+            ))
+    else:
+        tasks.append(LocalCopy(
+            name="Copy target directory",
+            src=str(SHARED_DIR),
+            dest=str(target_dir),
+            is_dir=True
+        ))
 
     if deploy_host == "localhost":
         deploy_host = "127.0.0.1"
 
-    docker_file, instance_services = adapt_docker_compose(
-        start_port,
-        deploy_host,
-        backend_map.layout,
-        config.boxes,
-        docker_file
-    )
+    docker_file, instance_services = template.render(start_port, deploy_host)
 
     tasks.append(WriteFile(
         name="Write docker-compose.yml",
         path=str(target_dir / 'docker-compose.yml'),
-        content=yaml.dump(docker_file)
+        content=docker_file
     ))
 
     return backend_map_lib.Instance(
@@ -187,6 +312,20 @@ def start_deployment(instance_id: int) -> list[Task]:
     ]
 
 
+def reset_deployment(instance_id: int,
+                     boxes: list[str] | None = None) -> list[Task]:
+    args = "up -d --no-build --force-recreate --renew-anon-volumes"
+    if boxes:
+        args += " --no-deps " + " ".join(boxes)
+    return [
+        DockerCompose(
+            name="Reset deployment",
+            args=args,
+            path=str("/home/{{ansible_user}}" / DEPLOY_DIR / str(instance_id))
+        )
+    ]
+
+
 def stop_deployment(instance_id: int) -> list[Task]:
     # subprocess.run(
     #     COMPOSE + ["down"], cwd=DEPLOY_DIR / str(instance_id)
@@ -200,6 +339,42 @@ def stop_deployment(instance_id: int) -> list[Task]:
     ]
 
 
+def teardown_deployments(instance_ids: list[str], workers: int) -> list[Task]:
+    # Removes the containers of many instances on one host in a single task,
+    # `workers` compose projects at a time. The directories are renamed into
+    # a tombstone and deleted by a detached process, so the task does not
+    # wait on the disk. Tombstones left behind by a deletion that was killed
+    # are removed first; recent ones may still be filled by another
+    # teardown and are left alone. An instance whose containers could not
+    # be removed keeps its directory, so it can be torn down again, and the
+    # task fails listing those instances once all others are done.
+    ids = " ".join(str(instance_id) for instance_id in instance_ids)
+    tombstone = f".tombstone-{time.time_ns()}"
+    cmd = (
+        "set -e\n"
+        "setsid nohup find . -maxdepth 1 -name '.tombstone-*' -mmin +10 "
+        "-exec rm -rf {} + > /dev/null 2>&1 &\n"
+        "if command -v docker-compose &> /dev/null; "
+        "then compose=docker-compose; else compose='docker compose'; fi\n"
+        f"failed=$(printf '%s\\n' {ids} | xargs -r -P {workers} -I @ "
+        "sh -c \"[ ! -d @ ] || (cd @ && $compose rm --force --stop) >&2 "
+        "|| echo @\" | tr '\\n' ' ')\n"
+        f"mkdir -p {tombstone}\n"
+        f"for id in {ids}; do case \" $failed \" in *\" $id \"*) ;; "
+        f"*) if [ -e $id ]; then mv $id {tombstone}/; fi ;; esac; done\n"
+        f"setsid nohup rm -rf {tombstone} > /dev/null 2>&1 &\n"
+        "if [ -n \"$failed\" ]; then echo \"Could not remove the containers "
+        "of instances ${failed% }\" >&2; exit 1; fi\n"
+    )
+    return [
+        Shell(
+            name=f"Tear down {len(instance_ids)} deployments",
+            cmd=cmd,
+            chdir=str("/home/{{ansible_user}}" / DEPLOY_DIR)
+        )
+    ]
+
+
 def delete_deployment(instance_id: int) -> list[Task]:
     # subprocess.run(
     #     COMPOSE + ["rm", "--force", "--stop"], cwd=DEPLOY_DIR / str(
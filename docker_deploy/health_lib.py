@@ -0,0 +1,24 @@
+import socket
+import time
+
+
+def accepts_connections(endpoint: str, timeout: float = 1.0) -> bool:
+    host, port = endpoint.rsplit(':', 1)
+    try:
+        with socket.create_connection((host, int(port)), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def wait_for_endpoints(endpoints: list[str], timeout: float,
+                       interval: float = 1.0) -> list[str]:
+    # Returns the endpoints that still refused connections at the deadline.
+    deadline = time.monotonic() + timeout
+    pending = list(endpoints)
+    while True:
+        pending = [endpoint for endpoint in pending
+                   if not accepts_connections(endpoint)]
+        if len(pending) == 0 or time.monotonic() >= deadline:
+            return pending
+        time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
@@ -0,0 +1,123 @@
+import fcntl
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from pathlib import Path
+
+from docker_deploy import backend_map_lib
+
+METRICS = {
+    'docker_deploy_phase_seconds':
+        'Seconds spent in each phase of the last run of a command.',
+    'docker_deploy_run_seconds':
+        'Seconds the last run of a command took.',
+    'docker_deploy_last_run_timestamp_seconds':
+        'Unix time the last run of a command finished.',
+}
+
+
+@dataclass
+class Span:
+    phase: str
+    start: float
+    # Excludes the time spent in spans nested in this one, so the phases of
+    # a run add up to at most its total.
+    duration: float
+
+
+# Spans of the current run. Phases can be entered from worker threads, so
+# appends are guarded. Each thread keeps the nested time of its open spans.
+_started = time.perf_counter()
+_spans: list[Span] = []
+_lock = threading.Lock()
+_open = threading.local()
+
+
+@contextmanager
+def span(phase: str):
+    nested = _open.__dict__.setdefault('nested', [])
+    nested.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        inner = nested.pop()
+        if nested:
+            nested[-1] += end - start
+        with _lock:
+            _spans.append(Span(phase, start - _started, end - start - inner))
+
+
+def phase_totals(spans: list[Span]) -> dict[str, float]:
+    totals = {}
+    for recorded in spans:
+        totals[recorded.phase] = totals.get(recorded.phase, 0) + \
+            recorded.duration
+    return totals
+
+
+def export(metrics_file: str | None, command: str):
+    total = time.perf_counter() - _started
+    totals = phase_totals(_spans)
+    logging.info(f'{command} took {total:.2f}s: ' + ", ".join(
+        f'{phase} {seconds:.2f}s' for phase, seconds in totals.items()))
+    if metrics_file is None:
+        return
+
+    # Metrics must never change the outcome of the command they measure.
+    try:
+        with open(f'{metrics_file}.prom.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            write_run(metrics_file, command, total, totals)
+    except OSError as error:
+        logging.warning(f'Could not write metrics to {metrics_file}: '
+                        f'{error}')
+
+
+def write_run(metrics_file: str, command: str, total: float,
+              totals: dict[str, float]):
+    finished = time.time()
+    with open(f'{metrics_file}.jsonl', 'a') as file:
+        file.write(json.dumps({
+            'time': finished,
+            'command': command,
+            'seconds': total,
+            'spans': [asdict(recorded) for recorded in _spans]
+        }) + "\n")
+
+    # The textfile keeps the last run of every command, so a destroy does
+    # not hide how long the last deploy took. Concurrent commands take
+    # turns under the lock, so none of their samples are lost.
+    label = f'command="{command}"'
+    samples = [line for line in read_samples(Path(f'{metrics_file}.prom'))
+               if label not in line.split('}')[0]]
+    samples.extend(
+        f'docker_deploy_phase_seconds{{{label},phase="{phase}"}} {seconds}'
+        for phase, seconds in totals.items())
+    samples.append(f'docker_deploy_run_seconds{{{label}}} {total}')
+    samples.append(
+        f'docker_deploy_last_run_timestamp_seconds{{{label}}} {finished}')
+    backend_map_lib.atomic_write(Path(f'{metrics_file}.prom'),
+                                 format_textfile(samples))
+
+
+def read_samples(path: Path) -> list[str]:
+    try:
+        lines = path.read_text().splitlines()
+    except FileNotFoundError:
+        return []
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def format_textfile(samples: list[str]) -> str:
+    lines = []
+    for name, description in METRICS.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.extend(sorted(sample for sample in samples
+                            if sample.split('{')[0] == name))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,84 @@
+import logging
+import subprocess
+import sys
+from pathlib import Path
+
+from docker_deploy import backend_map_lib
+from docker_deploy import scheduler_lib
+from docker_deploy import yaml_lib
+
+
+def pool_path(backend_map_file: str) -> Path:
+    return Path(backend_map_file).with_suffix('.pool.yml')
+
+
+def load_pool(backend_map_file: str,
+              backend_map: backend_map_lib.BackendMap
+              ) -> backend_map_lib.BackendMap:
+    # Warm instances are kept in a backend map of their own that the load
+    # balancer never sees, sharing the published map's layout.
+    try:
+        with open(pool_path(backend_map_file), 'r') as file:
+            data = yaml_lib.load(file) or []
+    except FileNotFoundError:
+        data = []
+    return backend_map_lib.BackendMap(
+        lb_endpoint=backend_map.lb_endpoint,
+        layout=backend_map.layout,
+        backends=[backend_map_lib.Instance.from_dict(instance)
+                  for instance in data]
+    )
+
+
+def save_pool(pool: backend_map_lib.BackendMap, backend_map_file: str):
+    if len(pool.pending_changes()) == 0:
+        return
+    backend_map_lib.atomic_write(
+        pool_path(backend_map_file),
+        yaml_lib.dump([instance.to_dict() for instance in pool.backends])
+    )
+    pool.pending_changes().clear()
+    logging.info(f'Pool saved to {pool_path(backend_map_file)}')
+
+
+def promote(count: int, pool: backend_map_lib.BackendMap,
+            backend_map: backend_map_lib.BackendMap,
+            possible_hosts: dict[str, dict] | list[str]) -> list[str]:
+    promoted = []
+    while len(promoted) < count:
+        hosts = [host for host in possible_hosts
+                 if pool.instance_ids_on_host(scheduler_lib.address(host))]
+        if len(hosts) == 0:
+            break
+        # Promote from the host with the fewest published services.
+        host = min(hosts, key=lambda candidate: backend_map.service_count(
+            scheduler_lib.address(candidate)))
+        instance_id = min(
+            pool.instance_ids_on_host(scheduler_lib.address(host)), key=int)
+        backend_map.add_instance(pool.remove_instance(instance_id))
+        promoted.append(instance_id)
+    if promoted:
+        logging.info(f'Promoted pool instances {", ".join(promoted)}.')
+    return promoted
+
+
+def missing(pool: backend_map_lib.BackendMap,
+            possible_hosts: dict[str, dict],
+            size: int) -> dict[str, int]:
+    standbys = {
+        host: len(pool.instance_ids_on_host(scheduler_lib.address(host)))
+        for host in possible_hosts
+    }
+    return {host: size - count for host, count in standbys.items()
+            if count < size}
+
+
+def refill_in_background():
+    subprocess.Popen(
+        [sys.executable, '-m', 'docker_deploy', 'pool', 'fill'],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True
+    )
+    logging.info('Started pool refill in the background.')
@@ -0,0 +1,108 @@
+from bisect import bisect_left, bisect_right, insort
+
+
+class PortAllocator:
+    # Free ports in [min_port, max_port] kept as sorted, disjoint intervals.
+    # Freed blocks are merged with their neighbours so holes get reused.
+    # The intervals are also indexed by (length, start), so a block is taken
+    # from the smallest interval it fits in with one binary search, however
+    # fragmented the range has become.
+
+    def __init__(self, min_port: int, max_port: int,
+                 used_ports: list[int] = ()):
+        if min_port > max_port:
+            raise ValueError("min_port must not be greater than max_port")
+        self.min_port = min_port
+        self.max_port = max_port
+        # Inclusive bounds of the free intervals, sorted by start.
+        self._starts: list[int] = []
+        self._ends: list[int] = []
+        # (length, start) of the same intervals, sorted.
+        self._by_size: list[tuple[int, int]] = []
+
+        next_free = min_port
+        for port in sorted(set(used_ports)):
+            if port < min_port or port > max_port:
+                continue
+            if port > next_free:
+                self._append(next_free, port - 1)
+            next_free = port + 1
+        if next_free <= max_port:
+            self._append(next_free, max_port)
+
+    def _append(self, start: int, end: int):
+        self._starts.append(start)
+        self._ends.append(end)
+        insort(self._by_size, (end - start + 1, start))
+
+    def _remove_size(self, start: int, end: int):
+        del self._by_size[bisect_left(self._by_size,
+                                      (end - start + 1, start))]
+
+    def free_count(self) -> int:
+        return sum(length for length, _ in self._by_size)
+
+    def allocate(self, size: int) -> int:
+        if size < 1:
+            raise ValueError("Block size must be at least 1")
+        # Best fit: the smallest interval that is large enough, the lowest
+        # of those on a tie. Larger intervals stay whole for larger blocks.
+        j = bisect_left(self._by_size, (size, self.min_port))
+        if j == len(self._by_size):
+            raise ValueError(
+                f"No block of {size} free ports left in range "
+                f"{self.min_port}-{self.max_port}")
+        length, start = self._by_size.pop(j)
+        i = bisect_left(self._starts, start)
+        if length == size:
+            del self._starts[i]
+            del self._ends[i]
+        else:
+            self._starts[i] = start + size
+            insort(self._by_size, (length - size, start + size))
+        return start
+
+    def allocate_many(self, count: int, size: int) -> list[int]:
+        blocks = []
+        try:
+            for _ in range(count):
+                blocks.append(self.allocate(size))
+        except ValueError:
+            for start in blocks:
+                self.free(start, size)
+            raise
+        return blocks
+
+    def free(self, start: int, size: int = 1):
+        end = start + size - 1
+        if start < self.min_port or end > self.max_port:
+            raise ValueError(f"Ports {start}-{end} are outside the range")
+        i = bisect_right(self._starts, start)
+        if (i > 0 and self._ends[i - 1] >= start) or \
+                (i < len(self._starts) and self._starts[i] <= end):
+            raise ValueError(f"Ports {start}-{end} are already free")
+
+        merge_left = i > 0 and self._ends[i - 1] == start - 1
+        merge_right = i < len(self._starts) and self._starts[i] == end + 1
+        if merge_left:
+            self._remove_size(self._starts[i - 1], self._ends[i - 1])
+            start = self._starts[i - 1]
+        if merge_right:
+            self._remove_size(self._starts[i], self._ends[i])
+            end = self._ends[i]
+        if merge_left and merge_right:
+            self._ends[i - 1] = end
+            del self._starts[i]
+            del self._ends[i]
+        elif merge_left:
+            self._ends[i - 1] = end
+        elif merge_right:
+            self._starts[i] = start
+        else:
+            self._starts.insert(i, start)
+            self._ends.insert(i, end)
+        insort(self._by_size, (end - start + 1, start))
+
+    def is_free(self, port: int) -> bool:
+        i = bisect_left(self._ends, port)
+        return i < len(self._starts) and self._starts[i] <= port
@@ -1,8 +1,19 @@
+import fcntl
+import hashlib
+import logging
+import os
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 
-import yaml
+from docker_deploy import backend_map_lib
+from docker_deploy import yaml_lib
+
+CACHE_FILE = "registry-cache.yml"
+LOCAL_REPOSITORY = "docker-deploy"
+MIRROR_WORKERS = 4
 
 
 @dataclass
@@ -11,18 +22,55 @@ class Buildable:
     dockerfile: str
     args: dict[str, str]
     tag: str
+    # The content_key() the tag was derived from, of which the tag only
+    # carries a prefix.
+    key: str = ""
 
-    def build(self):
-        subprocess.run([
+    def build_command(self, labels: dict[str, str] | None = None
+                      ) -> list[str]:
+        build_args = []
+        for key, value in self.args.items():
+            build_args.extend(['--build-arg', f'{key}={value}'])
+        for key, value in (labels or {}).items():
+            build_args.extend(['--label', f'{key}={value}'])
+        return [
             'docker', 'build',
             '.',
             '-t', self.tag,
-            '-f', self.dockerfile,
-            *[f'--build-arg {key}={value}' for key, value in self.args.items()]
-        ],cwd=self.context)
+            '-f', str(self.dockerfile),
+            *build_args
+        ]
+
+    def build(self, labels: dict[str, str] | None = None):
+        subprocess.run(self.build_command(labels), cwd=self.context,
+                       check=True)
 
     def push(self):
-        subprocess.run(['docker', 'push', self.tag])
+        subprocess.run(['docker', 'push', self.tag], check=True)
+
+    def content_key(self) -> str:
+        digest = hashlib.sha256()
+        context = Path(self.context)
+        for root, dirs, files in os.walk(context):
+            dirs.sort()
+            for file_name in sorted(files):
+                path = Path(root) / file_name
+                digest.update(str(path.relative_to(context)).encode())
+                digest.update(b'\0')
+                if path.is_symlink():
+                    digest.update(os.readlink(path).encode())
+                else:
+                    digest.update(path.read_bytes())
+                digest.update(b'\0')
+        digest.update(str(self.dockerfile).encode())
+        digest.update(b'\0')
+        dockerfile = context / self.dockerfile
+        if dockerfile.is_file() and \
+                context.resolve() not in dockerfile.resolve().parents:
+            digest.update(dockerfile.read_bytes())
+        for key, value in sorted(self.args.items()):
+            digest.update(f'{key}={value}\0'.encode())
+        return digest.hexdigest()
 
 
 def extract_images(docker_compose: dict) -> list[str]:
@@ -34,14 +82,120 @@ def extract_images(docker_compose: dict) -> list[str]:
 
 
 def pull_push_image(image: str, registry_url: str) -> str:
-    subprocess.run(['docker', 'pull', image])
-    name = image.split('/')[-1]
-    tag = f'{registry_url}/{name}'
-    subprocess.run(['docker', 'tag', image, tag])
-    subprocess.run(['docker', 'push', tag])
+    subprocess.run(['docker', 'pull', image], check=True)
+    tag = mirror_tag(image, registry_url)
+    subprocess.run(['docker', 'tag', image, tag], check=True)
+    subprocess.run(['docker', 'push', tag], check=True)
     return tag
 
 
+def mirror_tag(image: str, registry_url: str) -> str:
+    name = image.split('/')[-1]
+    return f'{registry_url}/{name}'
+
+
+def remote_digest(image: str) -> str | None:
+    result = subprocess.run(
+        ['docker', 'buildx', 'imagetools', 'inspect', image,
+         '--format', '{{.Manifest.Digest}}'],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0 or result.stdout.strip() == "":
+        return None
+    return result.stdout.strip()
+
+
+def load_cache(cache_file: str) -> dict:
+    try:
+        with open(cache_file, 'r') as file:
+            return yaml_lib.load(file) or {}
+    except FileNotFoundError:
+        return {}
+
+
+def save_cache(cache: dict, cache_file: str):
+    backend_map_lib.atomic_write(Path(cache_file), yaml_lib.dump(cache))
+
+
+def update_cache(cache_file: str, section: str, entries: dict):
+    # Images are prepared outside the state lock, so deploys may finish at
+    # the same time. The cache is read again under a lock of its own and
+    # only this run's entries are merged in, so none of them is lost.
+    if len(entries) == 0:
+        return
+    with open(f"{cache_file}.lock", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cache = load_cache(cache_file)
+        cache.setdefault(section, {}).update(entries)
+        save_cache(cache, cache_file)
+
+
+def mirror_image(image: str, registry_url: str,
+                 cached: dict | None) -> (str, dict, bool):
+    tag = mirror_tag(image, registry_url)
+    source_digest = remote_digest(image)
+    if cached is not None and source_digest is not None \
+            and cached.get('tag') == tag \
+            and cached.get('source_digest') == source_digest \
+            and cached.get('target_digest') is not None \
+            and remote_digest(tag) == cached['target_digest']:
+        return tag, cached, True
+
+    pull_push_image(image, registry_url)
+    return tag, {
+        'tag': tag,
+        'source_digest': source_digest,
+        'target_digest': remote_digest(tag)
+    }, False
+
+
+def run_timed(function, items: list, workers: int) -> list[tuple]:
+    # (result, seconds, error) for every item. All items are attempted even
+    # when one fails, so the ones that worked can still be cached.
+    def timed(item):
+        start = time.perf_counter()
+        try:
+            return function(item), time.perf_counter() - start, None
+        except (subprocess.CalledProcessError, OSError) as error:
+            return None, time.perf_counter() - start, error
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(timed, items))
+
+
+def mirror_images(images: list[str], registry_url: str,
+                  workers: int = MIRROR_WORKERS,
+                  cache_file: str = CACHE_FILE) -> list[str]:
+    mirrored = load_cache(cache_file).get('images', {})
+    unique_images = list(dict.fromkeys(images))
+
+    results = run_timed(
+        lambda image: mirror_image(image, registry_url, mirrored.get(image)),
+        unique_images, workers)
+
+    tags = {}
+    updated = {}
+    errors = []
+    for image, (result, elapsed, error) in zip(unique_images, results):
+        if error is not None:
+            logging.error(f"Failed to mirror {image} after {elapsed:.2f}s: "
+                          f"{error}")
+            errors.append(error)
+            continue
+        tag, entry, skipped = result
+        action = "Skipped unchanged" if skipped else "Mirrored"
+        logging.info(f"{action} {image} as {tag} in {elapsed:.2f}s")
+        print(f"{action} {image} as {tag} in {elapsed:.2f}s")
+        updated[image] = entry
+        tags[image] = tag
+
+    update_cache(cache_file, 'images', updated)
+    if errors:
+        raise errors[0]
+    return [tags[image] for image in images]
+
+
 def replace_images(docker_compose: dict, images: list[str],
                    image_tags: list[str]) -> dict:
     if len(images) != len(image_tags):
@@ -53,44 +207,117 @@ def replace_images(docker_compose: dict, images: list[str],
     return docker_compose
 
 
+def extract_buildable(service: dict, cwd: str) -> Buildable:
+    if type(service['build']) is str:
+        return Buildable(
+            context=Path(cwd) / service['build'],
+            dockerfile='Dockerfile',
+            args={},
+            tag="",
+        )
+    args = service['build'].get('args', {})
+    if type(args) is list:
+        args = dict(arg.split('=', 1) if '=' in arg else (arg, '')
+                    for arg in args)
+    return Buildable(
+        context=Path(cwd) / service['build'].get('context', '.'),
+        dockerfile=service['build'].get('dockerfile', 'Dockerfile'),
+        args=args,
+        tag="",
+    )
+
+
+def build_cached(name: str, extract: Buildable, registry_url: str,
+                 cached: dict | None) -> (dict, bool):
+    key = extract.content_key()
+    extract.key = key
+    extract.tag = f"{registry_url}/{name}:{key[:12]}"
+    if cached is not None and cached.get('content_key') == key \
+            and cached.get('tag') == extract.tag \
+            and remote_digest(extract.tag) is not None:
+        return cached, True
+
+    extract.build(labels={'docker_deploy.content_key': key})
+    extract.push()
+    return {'tag': extract.tag, 'content_key': key}, False
+
+
 def convert_buildable(docker_compose: dict, registry_url: str,
-                      cwd: str) -> dict:
+                      cwd: str, workers: int = MIRROR_WORKERS,
+                      cache_file: str = CACHE_FILE) -> dict:
+    builds = load_cache(cache_file).get('builds', {})
+    buildables = {
+        name: extract_buildable(service, cwd)
+        for name, service in docker_compose['services'].items()
+        if 'build' in service
+    }
+
+    results = run_timed(
+        lambda name: build_cached(name, buildables[name], registry_url,
+                                  builds.get(name)),
+        list(buildables), workers)
+
+    updated = {}
+    errors = []
+    for name, (result, elapsed, error) in zip(buildables, results):
+        if error is not None:
+            logging.error(f"Failed to build {name} after {elapsed:.2f}s: "
+                          f"{error}")
+            errors.append(error)
+            continue
+        entry, skipped = result
+        action = "Reused unchanged" if skipped else "Built"
+        logging.info(f"{action} {name} as {entry['tag']} in {elapsed:.2f}s")
+        print(f"{action} {name} as {entry['tag']} in {elapsed:.2f}s")
+        updated[name] = entry
+        service = docker_compose['services'][name]
+        service['image'] = entry['tag']
+        del service['build']
+
+    update_cache(cache_file, 'builds', updated)
+    if errors:
+        raise errors[0]
+    return docker_compose
+
+
+def convert_local_buildable(docker_compose: dict,
+                            cwd: str) -> list[Buildable]:
+    # Without a registry, each host builds every image once from its shared
+    # copy of the target. The tag carries the content key, so instances
+    # reuse the image and a changed context gets a new tag.
+    buildables = []
     for name, service in docker_compose['services'].items():
         if 'build' not in service:
             continue
-        tag = f"{registry_url}/{name}:latest"
-        if type(service['build']) is str:
-            extract = Buildable(
-                context=Path(cwd) / service['build'],
-                dockerfile='Dockerfile',
-                args={},
-                tag=tag,
-            )
-        else:
-            extract = Buildable(
-                context=Path(cwd) / service['build'].get('context', '.'),
-                dockerfile=service['build'].get('dockerfile', 'Dockerfile'),
-                args=service['build'].get('args', {}),
-                tag=tag,
-            )
-            print(extract)
-        extract.build()
-        extract.push()
-        service['image'] = tag
+        extract = extract_buildable(service, cwd)
+        if not Path(extract.context).is_dir():
+            continue
+        key = extract.content_key()
+        extract.key = key
+        extract.tag = f"{LOCAL_REPOSITORY}/{name}:{key[:12]}"
+        extract.context = os.path.relpath(extract.context, cwd)
+        service['image'] = extract.tag
         del service['build']
-    return docker_compose
+        buildables.append(extract)
+    return buildables
+
+
+def prebuild(docker_compose: str, cwd: str) -> (str, list[Buildable]):
+    docker_compose = yaml_lib.load(docker_compose)
+    buildables = convert_local_buildable(docker_compose, cwd)
+    return yaml_lib.dump(docker_compose), buildables
 
 
 def build(docker_compose: str, registry_url: str, cwd: str) -> str:
-    docker_compose = yaml.safe_load(docker_compose)
+    docker_compose = yaml_lib.load(docker_compose)
 
     images = extract_images(docker_compose)
-    image_tags = [pull_push_image(image, registry_url) for image in images]
+    image_tags = mirror_images(images, registry_url)
     docker_compose = replace_images(docker_compose, images, image_tags)
 
     docker_compose = convert_buildable(docker_compose, registry_url, cwd)
 
-    return yaml.dump(docker_compose)
+    return yaml_lib.dump(docker_compose)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,62 @@
+import fcntl
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from docker_deploy import backend_map_lib
+
+
+def request_reload(launch_command: dict, backend_map_file: str):
+    debounce = launch_command.get('debounce')
+    if not debounce:
+        backend_map_lib.run_launch_command(launch_command)
+        return
+
+    # Record when the reload was asked for and hand it to a detached
+    # worker. Workers take turns on a lock and each keeps waiting until no
+    # new request has arrived for `debounce` seconds, so a burst of
+    # commands ends in a single launch.
+    marker = Path(backend_map_file + '.reload')
+    backend_map_lib.atomic_write(marker, f"{time.time()}\n")
+    subprocess.Popen(
+        [sys.executable, '-m', 'docker_deploy.reload_lib',
+         str(marker), json.dumps(launch_command)],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True
+    )
+    logging.info(f'Launch command requested, debounced by {debounce}s')
+
+
+def read_marker(marker: Path) -> float | None:
+    try:
+        return float(marker.read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def run_worker(marker: Path, launch_command: dict):
+    debounce = float(launch_command['debounce'])
+    with open(marker.with_name(marker.name + '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        while True:
+            requested = read_marker(marker)
+            if requested is None:
+                return
+            wait = requested + debounce - time.time()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            if read_marker(marker) != requested:
+                continue
+            os.remove(marker)
+            backend_map_lib.run_launch_command(launch_command)
+
+
+if __name__ == '__main__':
+    run_worker(Path(sys.argv[1]), json.loads(sys.argv[2]))
@@ -0,0 +1,120 @@
+from dataclasses import dataclass
+
+from docker_deploy import backend_map_lib
+from docker_deploy import config_lib
+
+STRATEGIES = ('least-loaded', 'bin-pack')
+
+
+@dataclass
+class Capacity:
+    cpus: float | None = None
+    memory: int | None = None
+    instances: int | None = None
+
+    @classmethod
+    def from_host_vars(cls, host_vars: dict):
+        return cls(
+            cpus=host_vars.get('docker_deploy_cpus'),
+            memory=host_vars.get('docker_deploy_memory'),
+            instances=host_vars.get('docker_deploy_max_instances')
+        )
+
+
+@dataclass
+class Decision:
+    host: str
+    instances: int
+    load: float
+
+
+def address(host: str) -> str:
+    return '127.0.0.1' if host == 'localhost' else host
+
+
+class Scheduler:
+    # Places instances on hosts according to the capacity in their host
+    # vars and the cpus/memory each box needs. Loads are counted once per
+    # batch and updated as instances are placed.
+
+    def __init__(self, hosts: dict[str, dict], boxes: list[config_lib.Box],
+                 strategy: str = 'least-loaded'):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown placement strategy '{strategy}', "
+                             f"expected one of {', '.join(STRATEGIES)}")
+        self.capacities = {host: Capacity.from_host_vars(host_vars or {})
+                           for host, host_vars in hosts.items()}
+        self.cpus = sum(box.cpus for box in boxes)
+        self.memory = sum(box.memory for box in boxes)
+        self.strategy = strategy
+
+    def load(self, host: str, instances: int) -> float:
+        # Without any capacity vars this is the plain instance count, as
+        # every host then weighs the same.
+        capacity = self.capacities[host]
+        loads = [instances * (self.cpus or 1) / (capacity.cpus or 1)]
+        if capacity.memory and self.memory:
+            loads.append(instances * self.memory / capacity.memory)
+        if capacity.instances:
+            loads.append(instances / capacity.instances)
+        return max(loads)
+
+    def fits(self, host: str, instances: int) -> bool:
+        capacity = self.capacities[host]
+        if capacity.instances is not None and \
+                instances > capacity.instances:
+            return False
+        if capacity.cpus is not None and \
+                instances * self.cpus > capacity.cpus:
+            return False
+        if capacity.memory is not None and \
+                instances * self.memory > capacity.memory:
+            return False
+        return True
+
+    def spread(self, total: int, current: dict[str, int]) -> dict[str, int]:
+        # How many of `total` instances each host should run, placed from
+        # scratch so the result is balanced. Ties go to the hosts already
+        # running more instances, so a balanced fleet is left as it is.
+        counts = {host: 0 for host in self.capacities}
+        for number in range(1, total + 1):
+            candidates = [host for host in counts
+                          if self.fits(host, counts[host] + 1)]
+            if len(candidates) == 0:
+                raise ValueError(f"No host has capacity for instance "
+                                 f"{number} of {total}")
+            if self.strategy == 'bin-pack':
+                host = max(candidates, key=lambda host: (
+                    self.load(host, counts[host]), current.get(host, 0)))
+            else:
+                host = min(candidates, key=lambda host: (
+                    self.load(host, counts[host] + 1),
+                    -current.get(host, 0)))
+            counts[host] += 1
+        return counts
+
+    def place(self, count: int,
+              backend_maps: list[backend_map_lib.BackendMap]
+              ) -> list[Decision]:
+        counts = {
+            host: sum(len(backend_map.instance_ids_on_host(address(host)))
+                      for backend_map in backend_maps)
+            for host in self.capacities
+        }
+        decisions = []
+        for number in range(1, count + 1):
+            candidates = [host for host in counts
+                          if self.fits(host, counts[host] + 1)]
+            if len(candidates) == 0:
+                raise ValueError(f"No host has capacity for instance "
+                                 f"{number} of {count}")
+            if self.strategy == 'bin-pack':
+                host = max(candidates,
+                           key=lambda host: self.load(host, counts[host]))
+            else:
+                host = min(candidates,
+                           key=lambda host: self.load(host, counts[host] + 1))
+            counts[host] += 1
+            decisions.append(Decision(host, counts[host],
+                                      self.load(host, counts[host])))
+        return decisions
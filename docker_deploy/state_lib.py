@@ -0,0 +1,217 @@
+import fcntl
+import json
+import logging
+import os
+from pathlib import Path
+
+from docker_deploy.backend_map_lib import BackendMap, Instance, \
+    atomic_write
+
+COMPACT_EVERY = 1000
+
+
+def apply_change(backend_map: BackendMap, change: dict):
+    if change['op'] == 'add':
+        instance = Instance.from_dict(change['instance'])
+        backend_map.remove_instance(instance.id)
+        backend_map.add_instance(instance)
+    elif change['op'] == 'remove':
+        backend_map.remove_instance(change['id'])
+    elif change['op'] == 'clear':
+        backend_map.clear()
+    else:
+        raise ValueError(f"Unknown journal operation {change['op']}")
+
+
+class JournalStore:
+    # Backend map state kept as a JSON snapshot plus an append-only journal
+    # of per-instance changes. Every change carries a sequence number, and
+    # changes already folded into the snapshot are skipped on replay, so a
+    # crash during compaction cannot apply a change twice.
+
+    def __init__(self, path: str, compact_every: int = COMPACT_EVERY):
+        self.journal = Path(path)
+        self.snapshot = self.journal.with_name(self.journal.name + '.snapshot')
+        self.compact_every = compact_every
+        self.seq = 0
+        self.journal_length = 0
+
+    def load(self) -> BackendMap | None:
+        try:
+            with open(self.snapshot, 'r') as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            return None
+        backend_map = BackendMap.from_dict(snapshot['map'])
+        self.seq = snapshot['seq']
+
+        try:
+            with open(self.journal, 'r') as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            lines = []
+
+        for number, line in enumerate(lines):
+            try:
+                change = json.loads(line)
+            except json.JSONDecodeError:
+                if number == len(lines) - 1:
+                    logging.warning(
+                        f'Ignoring torn final entry in {self.journal}')
+                    break
+                raise
+            self.journal_length += 1
+            if change['seq'] <= self.seq:
+                continue
+            apply_change(backend_map, change)
+            self.seq = change['seq']
+
+        backend_map.pending_changes().clear()
+        logging.info(f'Loaded backend map state from {self.journal} '
+                     f'({self.journal_length} journal entries)')
+        return backend_map
+
+    def commit(self, backend_map: BackendMap):
+        if not self.snapshot.exists():
+            self.compact(backend_map)
+            return
+
+        changes = backend_map.pending_changes()
+        if len(changes) == 0:
+            return
+
+        lines = []
+        for change in changes:
+            self.seq += 1
+            lines.append(json.dumps({'seq': self.seq, **change}) + '\n')
+        with open(self.journal, 'a') as file:
+            file.writelines(lines)
+            file.flush()
+            os.fsync(file.fileno())
+        self.journal_length += len(lines)
+        changes.clear()
+
+        if self.journal_length >= self.compact_every:
+            self.compact(backend_map)
+
+    def compact(self, backend_map: BackendMap):
+        self.journal.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(self.snapshot, json.dumps({
+            'seq': self.seq,
+            'map': backend_map.to_dict()
+        }))
+        atomic_write(self.journal, '')
+        self.journal_length = 0
+        backend_map.pending_changes().clear()
+        logging.info(f'Compacted backend map state into {self.snapshot}')
+
+
+class StateLock:
+    # Exclusive lock around reading, planning and saving the state. The lock
+    # file also records the highest instance id ever handed out, so an id
+    # freed by a destroy that is still running is never reused, the ports
+    # such a destroy freed, which stay taken until its playbook is done, and
+    # the pool standbys still being started. Held ports and pending
+    # standbys belong to a process id and lapse when it exits.
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'a+')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+    def read(self) -> dict:
+        self.file.seek(0)
+        content = self.file.read().strip()
+        if not content:
+            content = '0'
+        if content.isdigit():
+            # Written before ports were held.
+            content = json.dumps({'last_instance_id': int(content)})
+        state = json.loads(content)
+        for key in ('held_ports', 'pending'):
+            state[key] = {pid: entries for pid, entries
+                          in state.get(key, {}).items()
+                          if is_running(int(pid))}
+        return state
+
+    def write(self, state: dict):
+        self.file.seek(0)
+        self.file.truncate()
+        self.file.write(json.dumps(state) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def last_instance_id(self) -> int:
+        return self.read()['last_instance_id']
+
+    def set_last_instance_id(self, instance_id: int):
+        state = self.read()
+        state['last_instance_id'] = instance_id
+        self.write(state)
+
+    def held_ports(self) -> set[int]:
+        return {port for ports in self.read()['held_ports'].values()
+                for port in ports}
+
+    def hold_ports(self, ports: set[int]):
+        if len(ports) == 0:
+            return
+        state = self.read()
+        pid = str(os.getpid())
+        state['held_ports'][pid] = sorted(
+            set(state['held_ports'].get(pid, [])) | ports)
+        self.write(state)
+
+    def release_ports(self, ports: set[int]):
+        state = self.read()
+        pid = str(os.getpid())
+        remaining = set(state['held_ports'].get(pid, [])) - ports
+        if remaining:
+            state['held_ports'][pid] = sorted(remaining)
+        else:
+            state['held_ports'].pop(pid, None)
+        self.write(state)
+
+    def pending(self) -> list[Instance]:
+        return [Instance.from_dict(instance)
+                for instances in self.read()['pending'].values()
+                for instance in instances]
+
+    def add_pending(self, instances: list[Instance]):
+        if len(instances) == 0:
+            return
+        state = self.read()
+        pid = str(os.getpid())
+        state['pending'].setdefault(pid, []).extend(
+            instance.to_dict() for instance in instances)
+        self.write(state)
+
+    def remove_pending(self, instance_ids: set[str]):
+        state = self.read()
+        pid = str(os.getpid())
+        remaining = [instance for instance in state['pending'].get(pid, [])
+                     if instance['id'] not in instance_ids]
+        if remaining:
+            state['pending'][pid] = remaining
+        else:
+            state['pending'].pop(pid, None)
+        self.write(state)
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
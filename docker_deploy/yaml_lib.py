@@ -0,0 +1,14 @@
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+
+def load(stream):
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def dump(data, stream=None):
+    return yaml.dump(data, stream, Dumper=SafeDumper)
@@ -0,0 +1,29 @@
+import pytest
+
+from docker_deploy import config_lib
+
+
+@pytest.fixture
+def boxes() -> list[config_lib.Box]:
+    return [
+        config_lib.Box(
+            name='web',
+            services=[
+                config_lib.Service(name='HTTP', description='Web server',
+                                   port=80, protocol='http'),
+                config_lib.Service(name='SSH', description='Shell',
+                                   port=22, protocol='tcp'),
+            ],
+            cpus=1,
+            memory=512
+        ),
+        config_lib.Box(
+            name='db',
+            services=[
+                config_lib.Service(name='Postgres', description='Database',
+                                   port=5432, protocol='tcp'),
+            ],
+            cpus=1,
+            memory=1024
+        ),
+    ]
@@ -0,0 +1,35 @@
+from docker_deploy import backend_map_lib
+
+LAYOUT = [backend_map_lib.Box(
+    id='web',
+    name='web',
+    services=[backend_map_lib.Service(id='HTTP', name='HTTP',
+                                      description='Web server',
+                                      proxy='http')]
+)]
+
+
+def make_instance(instance_id: str, host: str, start_port: int,
+                  layout: list[backend_map_lib.Box] = LAYOUT
+                  ) -> backend_map_lib.Instance:
+    # A service per service of the layout, on consecutive ports, as
+    # deploy_instances lays them out.
+    slots = [(box.id, service.id) for box in layout
+             for service in box.services]
+    return backend_map_lib.Instance(
+        id=instance_id,
+        services=[backend_map_lib.ServiceInstance(
+            box_id=box_id, service_id=service_id,
+            host=f'{host}:{start_port + slot}')
+            for slot, (box_id, service_id) in enumerate(slots)]
+    )
+
+
+def make_map(*instances: backend_map_lib.Instance,
+             layout: list[backend_map_lib.Box] = LAYOUT
+             ) -> backend_map_lib.BackendMap:
+    return backend_map_lib.BackendMap(
+        lb_endpoint='http://localhost:8000',
+        layout=layout,
+        backends=list(instances)
+    )
@@ -0,0 +1,76 @@
+from docker_deploy import yaml_lib
+from docker_deploy.ansible_deploy import HostTasksPlay, Play, Playbook, \
+    batch_by_host, instance_hosts
+from docker_deploy.ansible_deploy.task import Block, Mkdir
+
+
+def instance_play(instance_id: str, host: str) -> Play:
+    return Play(name=f'Deploy Instance {instance_id}',
+                tasks=[Mkdir(name='Create directory', path=instance_id)],
+                hosts=[host], instance_id=instance_id)
+
+
+def test_batch_by_host_gives_each_host_only_its_instances():
+    init = Play(name='Init Deploy Dir', tasks=[], hosts=['all'])
+    plays = [init, instance_play('1', 'a'), instance_play('2', 'b'),
+             instance_play('3', 'a')]
+    batched = batch_by_host(plays)
+
+    assert batched[0] is init
+    assert len(batched) == 2
+    merged = batched[1]
+    assert isinstance(merged, HostTasksPlay)
+    assert merged['hosts'] == ['a', 'b']
+    assert merged['name'] == '3 instances on a, b'
+    host_tasks = merged['host_tasks']
+    assert [block['vars'] for block in host_tasks['a']] == [
+        {'docker_deploy_instance': '1'}, {'docker_deploy_instance': '3'}]
+    assert [block['vars'] for block in host_tasks['b']] == [
+        {'docker_deploy_instance': '2'}]
+    assert all(isinstance(block, Block) and 'when' not in block.to_dict()
+               for block in merged['tasks'])
+    assert host_tasks['a'][0]['args'] == plays[1]['tasks']
+
+
+def test_batch_by_host_keeps_the_position_of_the_instances():
+    build = Play(name='Build Images', tasks=[], hosts=['a'])
+    batched = batch_by_host([instance_play('1', 'a'), build,
+                             instance_play('2', 'a')])
+    assert isinstance(batched[0], HostTasksPlay)
+    assert batched[1] is build
+
+
+def test_batch_by_host_keeps_plays_without_an_instance():
+    plays = [Play(name='Destroy 2 instances on a', tasks=[], hosts=['a']),
+             Play(name='Build Images', tasks=[], hosts=['a', 'b'])]
+    assert batch_by_host(plays) == plays
+    assert batch_by_host([]) == []
+
+
+def test_playbook_writes_a_task_file_per_host(tmp_path):
+    playbook = Playbook(batch_by_host([instance_play('1', 'a'),
+                                       instance_play('2', 'b'),
+                                       instance_play('3', 'a')]))
+    playbook.write(str(tmp_path / 'playbook.yml'))
+
+    with open(tmp_path / 'playbook.yml') as file:
+        play, = yaml_lib.load(file)
+    assert play['hosts'] == ['a', 'b']
+    assert play['tasks'] == [{
+        'name': 'Run the tasks of this host',
+        'include_tasks': '{{ docker_deploy_task_files[inventory_hostname] }}'
+    }]
+    task_files = play['vars']['docker_deploy_task_files']
+    with open(task_files['a']) as file:
+        blocks = yaml_lib.load(file)
+    assert [block['vars']['docker_deploy_instance'] for block in blocks] == \
+        ['1', '3']
+    assert blocks[0]['block'] == [{'name': 'Create directory',
+                                   'file': {'path': '1',
+                                            'state': 'directory'}}]
+
+
+def test_instance_hosts():
+    plays = [Play(name='Init', tasks=[], hosts=['all']),
+             instance_play('1', 'a'), instance_play('2', 'b')]
+    assert instance_hosts(plays) == {'1': 'a', '2': 'b'}
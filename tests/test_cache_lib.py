@@ -0,0 +1,74 @@
+import pytest
+
+from docker_deploy import ansible_deploy
+from docker_deploy import cache_lib
+
+CONFIG = '''
+version: 1
+target: ./docker
+lb_endpoint: http://localhost:8000
+launch_command: {}
+stop_command: {}
+inventory: ./inventory.sh
+output:
+  backend_map: ./backend-map.yml
+  min_port: 3000
+  max_port: 7999
+  interface_ip: 127.0.0.1
+boxes:
+  - name: nginx
+    services:
+      - name: HTTP
+        description: Web server
+        port: 80
+        protocol: http
+'''
+
+
+@pytest.fixture
+def config_file(tmp_path, monkeypatch) -> str:
+    (tmp_path / 'config.yml').write_text(CONFIG)
+    inventory = tmp_path / 'inventory.sh'
+    inventory.write_text('#!/bin/sh\necho "{}"\n')
+    inventory.chmod(0o755)
+    monkeypatch.chdir(tmp_path)
+    return str(tmp_path / 'config.yml')
+
+
+@pytest.fixture
+def inventory_reads(monkeypatch) -> list[str]:
+    reads = []
+
+    def get_hosts(inventory):
+        reads.append(inventory)
+        return {'10.0.0.1': {}}
+
+    monkeypatch.setattr(ansible_deploy, 'get_hosts', get_hosts)
+    return reads
+
+
+def test_a_snapshot_without_hosts_never_reads_the_inventory(
+        config_file, inventory_reads):
+    snapshot = cache_lib.load_snapshot(config_file, with_hosts=False)
+    assert snapshot.hosts is None
+    assert [box.name for box in snapshot.layout] == ['nginx']
+    assert cache_lib.load_snapshot(config_file, with_hosts=False).created \
+        == snapshot.created
+    assert inventory_reads == []
+
+
+def test_hosts_are_read_once_a_command_needs_them(config_file,
+                                                  inventory_reads):
+    cache_lib.load_snapshot(config_file, with_hosts=False)
+    snapshot = cache_lib.load_snapshot(config_file)
+    assert snapshot.hosts == {'10.0.0.1': {}}
+    assert inventory_reads == ['./inventory.sh']
+
+
+def test_a_stale_dynamic_inventory_does_not_rebuild_for_queries(
+        config_file, inventory_reads):
+    # A dynamic inventory without a TTL is never fresh.
+    cache_lib.load_snapshot(config_file)
+    snapshot = cache_lib.load_snapshot(config_file, with_hosts=False)
+    assert snapshot.hosts == {'10.0.0.1': {}}
+    assert inventory_reads == ['./inventory.sh']
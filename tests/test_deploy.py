@@ -0,0 +1,127 @@
+import pytest
+
+from docker_deploy import backend_map_lib
+from docker_deploy import config_lib
+from docker_deploy import deploy
+from tests.helpers import make_instance, make_map
+
+COMPOSE = '''
+services:
+  web:
+    image: nginx
+  db:
+    image: postgres
+'''
+
+HOSTS = {'10.0.0.1': {}, '10.0.0.2': {}}
+
+
+@pytest.fixture
+def config(boxes) -> config_lib.Config:
+    return config_lib.Config(
+        version=1,
+        output=config_lib.Output(backend_map='backend-map.yml',
+                                 min_port=2000, max_port=2999,
+                                 interface_ip='0.0.0.0'),
+        target='.',
+        lb_endpoint='http://localhost:8000',
+        launch_command={},
+        stop_command={},
+        boxes=boxes
+    )
+
+
+@pytest.fixture
+def layout(boxes) -> list[backend_map_lib.Box]:
+    return backend_map_lib.config_boxes_to_backend_map_boxes(boxes)
+
+
+def instance(instance_id: int, host: str, layout) -> backend_map_lib.Instance:
+    return make_instance(str(instance_id), host, 2000 + 3 * instance_id,
+                         layout=layout)
+
+
+def scale(count, backend_map, pool, config, per_host=False,
+          hosts=HOSTS):
+    return deploy.scale_instances(count, per_host, backend_map, pool, config,
+                                  1, hosts, source=(COMPOSE, []))
+
+
+def ids_by_host(backend_map) -> dict[str, list[str]]:
+    return {host: sorted(backend_map.instance_ids_on_host(host), key=int)
+            for host in HOSTS
+            if backend_map.instance_ids_on_host(host)}
+
+
+def play_names(plays) -> list[str]:
+    return [play['name'] for play in plays]
+
+
+def test_scale_spreads_new_instances_over_the_hosts(config, layout):
+    backend_map, plays = scale(4, make_map(layout=layout),
+                               make_map(layout=layout), config)
+    assert ids_by_host(backend_map) == {'10.0.0.1': ['1', '2'],
+                                        '10.0.0.2': ['3', '4']}
+    assert play_names(plays)[1:] == [f'Deploy Instance {number}'
+                                     for number in range(1, 5)]
+
+
+def test_scale_per_host_targets_each_host(config, layout):
+    backend_map = make_map(instance(1, '10.0.0.1', layout), layout=layout)
+    backend_map, plays = scale(2, backend_map, make_map(layout=layout),
+                               config, per_host=True)
+    assert ids_by_host(backend_map) == {'10.0.0.1': ['1', '2'],
+                                        '10.0.0.2': ['3', '4']}
+    assert [play['hosts'] for play in plays[1:]] == [
+        ['10.0.0.1'], ['10.0.0.2'], ['10.0.0.2']]
+
+
+def test_scale_per_host_refuses_a_host_without_capacity(config, layout):
+    hosts = {'10.0.0.1': {'docker_deploy_max_instances': 1}}
+    with pytest.raises(ValueError):
+        scale(2, make_map(layout=layout), make_map(layout=layout), config,
+              per_host=True, hosts=hosts)
+
+
+def test_scale_moves_instances_off_a_crowded_host(config, layout):
+    backend_map = make_map(*[instance(number, '10.0.0.1', layout)
+                             for number in range(1, 5)], layout=layout)
+    backend_map, plays = scale(4, backend_map, make_map(layout=layout),
+                               config)
+    assert ids_by_host(backend_map) == {'10.0.0.1': ['1', '2'],
+                                        '10.0.0.2': ['5', '6']}
+    assert play_names(plays) == ['Init Deploy Dir', 'Deploy Instance 5',
+                                 'Deploy Instance 6', 'Destroy Instance 4',
+                                 'Destroy Instance 3']
+
+
+def test_scale_down_deletes_the_newest_instances_first(config, layout):
+    backend_map = make_map(*[instance(number, f'10.0.0.{number % 2 + 1}',
+                                      layout)
+                             for number in range(1, 7)], layout=layout)
+    backend_map, plays = scale(2, backend_map, make_map(layout=layout),
+                               config)
+    assert ids_by_host(backend_map) == {'10.0.0.1': ['2'],
+                                        '10.0.0.2': ['1']}
+    assert play_names(plays) == ['Destroy Instance 5', 'Destroy Instance 3',
+                                 'Destroy Instance 6', 'Destroy Instance 4']
+
+
+def test_scale_promotes_standbys_before_deploying(config, layout):
+    pool = make_map(instance(7, '10.0.0.2', layout),
+                    instance(8, '10.0.0.1', layout), layout=layout)
+    backend_map, plays = scale(3, make_map(layout=layout), pool, config)
+    assert ids_by_host(backend_map) == {'10.0.0.1': ['8', '9'],
+                                        '10.0.0.2': ['7']}
+    assert pool.backends == []
+    assert play_names(plays) == ['Init Deploy Dir', 'Deploy Instance 9']
+
+
+def test_scale_to_the_same_count_is_a_no_op(config, layout):
+    backend_map, _ = scale(3, make_map(layout=layout),
+                           make_map(layout=layout), config)
+    before = ids_by_host(backend_map)
+    backend_map, plays = scale(3, backend_map, make_map(layout=layout),
+                               config)
+    assert plays == []
+    assert ids_by_host(backend_map) == before
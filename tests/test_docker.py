@@ -0,0 +1,68 @@
+import os
+import subprocess
+
+import pytest
+
+from docker_deploy import backend_map_lib
+from docker_deploy import docker
+from docker_deploy import yaml_lib
+
+COMPOSE = '''
+services:
+  web:
+    image: nginx
+    ports:
+      - 8080:80
+  db:
+    image: postgres
+'''
+
+
+def test_compose_template_renders_a_port_per_service(boxes):
+    layout = backend_map_lib.config_boxes_to_backend_map_boxes(boxes)
+    template = docker.ComposeTemplate(COMPOSE, layout, boxes)
+    assert len(template.slots) == 3
+
+    text, services = template.render(2000, '10.0.0.1')
+    compose = yaml_lib.load(text)
+    assert compose['services']['web']['ports'] == ['10.0.0.1:2000:80',
+                                                   '10.0.0.1:2001:22']
+    assert compose['services']['db']['ports'] == ['10.0.0.1:2002:5432']
+    assert [service.host for service in services] == [
+        '10.0.0.1:2000', '10.0.0.1:2001', '10.0.0.1:2002']
+    assert services[2].box_id == layout[1].id
+    assert services[2].service_id == layout[1].services[0].id
+    assert '__docker_deploy_port_' not in text
+
+
+def test_compose_template_renders_instances_independently(boxes):
+    layout = backend_map_lib.config_boxes_to_backend_map_boxes(boxes)
+    template = docker.ComposeTemplate(COMPOSE, layout, boxes)
+    first, _ = template.render(2000, '127.0.0.1')
+    second, _ = template.render(3000, '127.0.0.1')
+    assert yaml_lib.load(first)['services']['db']['ports'] == \
+        ['127.0.0.1:2002:5432']
+    assert yaml_lib.load(second)['services']['db']['ports'] == \
+        ['127.0.0.1:3002:5432']
+
+
+def test_teardown_keeps_going_past_a_failed_compose_rm(tmp_path, monkeypatch):
+    # A docker-compose that fails in the directory of instance 2.
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'docker-compose').write_text(
+        '#!/bin/sh\n[ "$(basename "$PWD")" != 2 ]\n')
+    (bin_dir / 'docker-compose').chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}:{os.environ['PATH']}")
+    deployments = tmp_path / 'deployments'
+    for instance_id in ('1', '2', '3'):
+        (deployments / instance_id).mkdir(parents=True)
+
+    task = docker.teardown_deployments(['1', '2', '3', '4'], 2)[0]
+    task['args']['chdir'] = str(deployments)
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        task.run_local({})
+    assert 'Could not remove the containers of instances 2\n' == \
+        error.value.stderr
+    assert [path.name for path in deployments.iterdir()
+            if not path.name.startswith('.tombstone-')] == ['2']
@@ -0,0 +1,39 @@
+from docker_deploy.ansible_deploy.events import EventReport, TaskEvent
+
+
+def event(host, instance, status) -> TaskEvent:
+    return TaskEvent(host=host, task='Start', instance=instance, start=0.0,
+                     end=1.0, status=status)
+
+
+def report(*events: TaskEvent, returncode: int = 0) -> EventReport:
+    result = EventReport()
+    for item in events:
+        result.add(item)
+    result.returncode = returncode
+    return result
+
+
+INSTANCE_HOSTS = {'1': 'h1', '2': 'h1', '3': 'h2'}
+
+
+def test_a_failed_task_fails_the_instances_left_on_its_host():
+    failed = report(event('h1', '1', 'failed'), event('h2', '3', 'ok'),
+                    returncode=2).failed_instances(INSTANCE_HOSTS)
+    assert failed == {'1', '2'}
+
+
+def test_a_clean_run_fails_nothing():
+    failed = report(event('h1', '1', 'ok'), event('h1', '2', 'ok'),
+                    event('h2', '3', 'ok')).failed_instances(INSTANCE_HOSTS)
+    assert failed == set()
+
+
+def test_an_aborted_run_fails_the_instances_that_never_ran():
+    # ansible-playbook exits non-zero before any task, e.g. on a syntax
+    # error or an unreadable inventory.
+    assert report(returncode=4).failed_instances(INSTANCE_HOSTS) == \
+        {'1', '2', '3'}
+    failed = report(event('h1', '1', 'ok'),
+                    returncode=1).failed_instances(INSTANCE_HOSTS)
+    assert failed == {'2', '3'}
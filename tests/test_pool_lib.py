@@ -0,0 +1,33 @@
+from docker_deploy import pool_lib
+from tests.helpers import make_instance, make_map
+
+
+def test_missing_counts_standbys_per_host():
+    pool = make_map(make_instance('1', '127.0.0.1', 1000),
+                    make_instance('2', '10.0.0.2', 1001),
+                    make_instance('3', '10.0.0.2', 1002))
+    hosts = {'localhost': {}, '10.0.0.2': {}, '10.0.0.3': {}}
+    assert pool_lib.missing(pool, hosts, 2) == {'localhost': 1,
+                                                 '10.0.0.3': 2}
+    assert pool_lib.missing(pool, hosts, 1) == {'10.0.0.3': 1}
+
+
+def test_promote_moves_the_lowest_ids_from_the_least_busy_host():
+    pool = make_map(make_instance('4', '10.0.0.1', 1003),
+                    make_instance('5', '10.0.0.2', 1004),
+                    make_instance('6', '10.0.0.2', 1005))
+    backend_map = make_map(make_instance('1', '10.0.0.1', 1000),
+                           make_instance('2', '10.0.0.1', 1001))
+    promoted = pool_lib.promote(2, pool, backend_map,
+                                {'10.0.0.1': {}, '10.0.0.2': {}})
+    assert promoted == ['5', '6']
+    assert {instance.id for instance in backend_map.backends} == \
+        {'1', '2', '5', '6'}
+    assert [instance.id for instance in pool.backends] == ['4']
+
+
+def test_promote_stops_when_the_pool_is_empty():
+    pool = make_map(make_instance('3', '127.0.0.1', 1002))
+    backend_map = make_map()
+    assert pool_lib.promote(3, pool, backend_map, ['localhost']) == ['3']
+    assert pool.backends == []
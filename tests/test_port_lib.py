@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from docker_deploy.port_lib import PortAllocator
+
+
+def test_allocate_skips_used_ports():
+    allocator = PortAllocator(1000, 1009, [1000, 1001, 1003])
+    assert allocator.allocate(1) == 1002
+    assert allocator.allocate(3) == 1004
+    assert allocator.free_count() == 3
+
+
+def test_allocate_needs_a_contiguous_block():
+    allocator = PortAllocator(1000, 1009, [1002, 1005])
+    assert allocator.allocate(4) == 1006
+    with pytest.raises(ValueError):
+        allocator.allocate(3)
+
+
+def test_allocate_many_is_all_or_nothing():
+    allocator = PortAllocator(1000, 1009)
+    with pytest.raises(ValueError):
+        allocator.allocate_many(4, 3)
+    assert allocator.free_count() == 10
+    assert allocator.allocate_many(3, 3) == [1000, 1003, 1006]
+
+
+def test_free_merges_neighbours():
+    allocator = PortAllocator(1000, 1009)
+    allocator.allocate_many(5, 2)
+    allocator.free(1002, 2)
+    allocator.free(1006, 2)
+    allocator.free(1004, 2)
+    assert allocator.free_count() == 6
+    assert allocator.allocate(6) == 1002
+
+
+def test_free_rejects_free_and_out_of_range_ports():
+    allocator = PortAllocator(1000, 1009, [1000, 1001])
+    with pytest.raises(ValueError):
+        allocator.free(1001, 2)
+    with pytest.raises(ValueError):
+        allocator.free(1009, 2)
+    assert allocator.is_free(1002)
+    assert not allocator.is_free(1001)
+
+
+def test_allocate_takes_the_smallest_hole_that_fits():
+    allocator = PortAllocator(1000, 1019, [1003, 1006, 1007])
+    # Free: 1000-1002 (3), 1004-1005 (2), 1008-1019 (12).
+    assert allocator.allocate(2) == 1004
+    assert allocator.allocate(3) == 1000
+    assert allocator.allocate(4) == 1008
+
+
+def test_allocate_and_free_agree_with_a_port_set():
+    rng = random.Random(1)
+    allocator = PortAllocator(1000, 1199)
+    used = set()
+    blocks = []
+    for _ in range(2000):
+        if blocks and rng.random() < 0.5:
+            start, size = blocks.pop(rng.randrange(len(blocks)))
+            allocator.free(start, size)
+            used -= set(range(start, start + size))
+        else:
+            size = rng.randint(1, 6)
+            try:
+                start = allocator.allocate(size)
+            except ValueError:
+                continue
+            block = set(range(start, start + size))
+            assert not block & used
+            used |= block
+            blocks.append((start, size))
+        assert allocator.free_count() == 200 - len(used)
+        assert all(allocator.is_free(port) != (port in used)
+                   for port in range(1000, 1200, 7))
@@ -0,0 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from docker_deploy import registry
+
+
+def test_update_cache_merges_into_what_is_on_disk(tmp_path):
+    cache_file = str(tmp_path / 'registry-cache.yml')
+    registry.update_cache(cache_file, 'images', {'nginx': {'tag': 'a'}})
+    registry.update_cache(cache_file, 'builds', {'web': {'tag': 'b'}})
+    registry.update_cache(cache_file, 'images', {'redis': {'tag': 'c'}})
+    assert registry.load_cache(cache_file) == {
+        'images': {'nginx': {'tag': 'a'}, 'redis': {'tag': 'c'}},
+        'builds': {'web': {'tag': 'b'}}
+    }
+
+
+def test_concurrent_updates_keep_every_entry(tmp_path):
+    cache_file = str(tmp_path / 'registry-cache.yml')
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda number: registry.update_cache(
+            cache_file, 'images', {f'image{number}': {'tag': str(number)}}),
+            range(32)))
+    assert len(registry.load_cache(cache_file)['images']) == 32
@@ -0,0 +1,56 @@
+import pytest
+
+from docker_deploy.scheduler_lib import Scheduler
+from tests.helpers import make_instance, make_map
+
+
+def test_spread_balances_hosts_without_capacity_vars(boxes):
+    scheduler = Scheduler({'a': {}, 'b': {}, 'c': {}}, boxes)
+    assert scheduler.spread(7, {}) == {'a': 3, 'b': 2, 'c': 2}
+
+
+def test_spread_keeps_a_balanced_fleet_in_place(boxes):
+    scheduler = Scheduler({'a': {}, 'b': {}}, boxes)
+    assert scheduler.spread(3, {'a': 1, 'b': 2}) == {'a': 1, 'b': 2}
+
+
+def test_spread_weighs_hosts_by_capacity(boxes):
+    scheduler = Scheduler({
+        'big': {'docker_deploy_cpus': 8},
+        'small': {'docker_deploy_cpus': 2},
+    }, boxes)
+    assert scheduler.spread(5, {}) == {'big': 4, 'small': 1}
+
+
+def test_spread_fails_beyond_capacity(boxes):
+    scheduler = Scheduler({
+        'a': {'docker_deploy_max_instances': 2},
+        'b': {'docker_deploy_memory': 3072},
+    }, boxes)
+    assert scheduler.spread(4, {}) == {'a': 2, 'b': 2}
+    with pytest.raises(ValueError):
+        scheduler.spread(5, {})
+
+
+def test_place_counts_existing_instances(boxes):
+    scheduler = Scheduler({'localhost': {}, '10.0.0.2': {}}, boxes)
+    backend_map = make_map(make_instance('1', '127.0.0.1', 1000),
+                           make_instance('2', '127.0.0.1', 1001))
+    decisions = scheduler.place(3, [backend_map])
+    assert [decision.host for decision in decisions] == \
+        ['10.0.0.2', '10.0.0.2', 'localhost']
+    assert decisions[-1].instances == 3
+
+
+def test_bin_pack_fills_the_fullest_host_first(boxes):
+    scheduler = Scheduler({
+        'a': {'docker_deploy_max_instances': 2},
+        'b': {'docker_deploy_max_instances': 4},
+    }, boxes, 'bin-pack')
+    decisions = scheduler.place(4, [make_map()])
+    assert [decision.host for decision in decisions] == ['a', 'a', 'b', 'b']
+
+
+def test_unknown_strategy_is_rejected(boxes):
+    with pytest.raises(ValueError):
+        Scheduler({'a': {}}, boxes, 'random')
@@ -0,0 +1,132 @@
+import json
+
+import pytest
+
+from docker_deploy.state_lib import JournalStore, StateLock
+from tests.helpers import make_instance, make_map
+
+
+def committed_store(path, compact_every=1000) -> JournalStore:
+    store = JournalStore(str(path), compact_every)
+    backend_map = make_map()
+    store.commit(backend_map)
+    for number in range(1, 4):
+        backend_map.add_instance(make_instance(str(number), '10.0.0.1',
+                                               1000 + number))
+        store.commit(backend_map)
+    return store
+
+
+def test_load_replays_the_journal(tmp_path):
+    committed_store(tmp_path / 'state')
+    backend_map = JournalStore(str(tmp_path / 'state')).load()
+    assert [instance.id for instance in backend_map.backends] == \
+        ['1', '2', '3']
+    assert backend_map.pending_changes() == []
+
+
+def test_load_ignores_a_torn_final_line(tmp_path):
+    committed_store(tmp_path / 'state')
+    with open(tmp_path / 'state', 'a') as file:
+        file.write('{"seq": 4, "op": "remo')
+    backend_map = JournalStore(str(tmp_path / 'state')).load()
+    assert len(backend_map.backends) == 3
+
+
+def test_load_rejects_a_torn_line_before_the_end(tmp_path):
+    committed_store(tmp_path / 'state')
+    lines = (tmp_path / 'state').read_text().splitlines(keepends=True)
+    lines[0] = lines[0][:10] + '\n'
+    (tmp_path / 'state').write_text(''.join(lines))
+    with pytest.raises(json.JSONDecodeError):
+        JournalStore(str(tmp_path / 'state')).load()
+
+
+def test_compaction_folds_the_journal_into_the_snapshot(tmp_path):
+    store = committed_store(tmp_path / 'state', compact_every=2)
+    assert store.journal_length < 2
+    snapshot = json.loads((tmp_path / 'state.snapshot').read_text())
+    assert snapshot['seq'] >= 2
+
+    backend_map = JournalStore(str(tmp_path / 'state')).load()
+    assert [instance.id for instance in backend_map.backends] == \
+        ['1', '2', '3']
+
+
+def test_replay_skips_changes_already_in_the_snapshot(tmp_path):
+    store = committed_store(tmp_path / 'state')
+    journal = (tmp_path / 'state').read_text()
+    store.compact(JournalStore(str(tmp_path / 'state')).load())
+    # As if the crash came after writing the snapshot but before the
+    # journal was truncated.
+    (tmp_path / 'state').write_text(journal)
+    backend_map = JournalStore(str(tmp_path / 'state')).load()
+    assert len(backend_map.backends) == 3
+
+
+def test_removals_and_clears_are_replayed(tmp_path):
+    store = committed_store(tmp_path / 'state')
+    backend_map = JournalStore(str(tmp_path / 'state')).load()
+    backend_map.remove_instance('2')
+    store.commit(backend_map)
+    assert [instance.id for instance in
+            JournalStore(str(tmp_path / 'state')).load().backends] == \
+        ['1', '3']
+
+    backend_map.clear()
+    store.commit(backend_map)
+    assert JournalStore(str(tmp_path / 'state')).load().backends == []
+
+
+def test_load_without_a_snapshot(tmp_path):
+    assert JournalStore(str(tmp_path / 'state')).load() is None
+
+
+def test_lock_reads_a_plain_instance_id(tmp_path):
+    (tmp_path / 'lock').write_text('7\n')
+    with StateLock(str(tmp_path / 'lock')) as lock:
+        assert lock.last_instance_id() == 7
+        assert lock.held_ports() == set()
+
+
+def test_lock_holds_ports_until_released(tmp_path):
+    with StateLock(str(tmp_path / 'lock')) as lock:
+        lock.set_last_instance_id(3)
+        lock.hold_ports({1000, 1001})
+    with StateLock(str(tmp_path / 'lock')) as lock:
+        assert lock.held_ports() == {1000, 1001}
+        lock.release_ports({1000})
+        assert lock.held_ports() == {1001}
+        assert lock.last_instance_id() == 3
+
+
+def test_lock_drops_ports_of_exited_processes(tmp_path):
+    (tmp_path / 'lock').write_text(json.dumps({
+        'last_instance_id': 1,
+        'held_ports': {'999999999': [1000]}
+    }))
+    with StateLock(str(tmp_path / 'lock')) as lock:
+        assert lock.held_ports() == set()
+
+
+def test_lock_records_pending_standbys_until_removed(tmp_path):
+    with StateLock(str(tmp_path / 'lock')) as lock:
+        lock.add_pending([make_instance('4', '10.0.0.1', 1000),
+                          make_instance('5', '10.0.0.2', 1001)])
+    with StateLock(str(tmp_path / 'lock')) as lock:
+        assert [instance.id for instance in lock.pending()] == ['4', '5']
+        assert lock.pending()[1].services[0].host == '10.0.0.2:1001'
+        lock.remove_pending({'4'})
+        assert [instance.id for instance in lock.pending()] == ['5']
+        lock.remove_pending({'5'})
+        assert lock.pending() == []
+
+
+def test_lock_drops_standbys_of_exited_processes(tmp_path):
+    (tmp_path / 'lock').write_text(json.dumps({
+        'last_instance_id': 1,
+        'pending': {'999999999': [
+            make_instance('1', '10.0.0.1', 1000).to_dict()]}
+    }))
+    with StateLock(str(tmp_path / 'lock')) as lock:
+        assert lock.pending() == []
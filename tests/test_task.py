@@ -0,0 +1,71 @@
+import os
+
+from docker_deploy.ansible_deploy.task import Sync
+
+
+def sync(src, dest):
+    Sync(name='Sync', src=str(src), dest=str(dest)).run_local({})
+
+
+def test_sync_copies_a_tree(tmp_path):
+    (tmp_path / 'src' / 'conf').mkdir(parents=True)
+    (tmp_path / 'src' / 'conf' / 'app.ini').write_text('port=80')
+    (tmp_path / 'src' / 'Dockerfile').write_text('FROM nginx')
+    sync(tmp_path / 'src', tmp_path / 'dest')
+    assert (tmp_path / 'dest' / 'conf' / 'app.ini').read_text() == 'port=80'
+    assert (tmp_path / 'dest' / 'Dockerfile').read_text() == 'FROM nginx'
+
+
+def test_sync_deletes_what_src_no_longer_has(tmp_path):
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'src' / 'kept').write_text('kept')
+    (tmp_path / 'dest' / 'old' / 'nested').mkdir(parents=True)
+    (tmp_path / 'dest' / 'old' / 'nested' / 'file').write_text('old')
+    (tmp_path / 'dest' / 'stale').write_text('stale')
+    (tmp_path / 'dest' / 'kept').write_text('outdated')
+    sync(tmp_path / 'src', tmp_path / 'dest')
+    assert sorted(os.listdir(tmp_path / 'dest')) == ['kept']
+    assert (tmp_path / 'dest' / 'kept').read_text() == 'kept'
+
+
+def test_sync_copies_symlinks_as_links(tmp_path):
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'src' / 'real').write_text('data')
+    (tmp_path / 'src' / 'link').symlink_to('real')
+    (tmp_path / 'src' / 'dangling').symlink_to('missing')
+    (tmp_path / 'dest').mkdir()
+    (tmp_path / 'dest' / 'link').symlink_to('elsewhere')
+    sync(tmp_path / 'src', tmp_path / 'dest')
+    assert os.readlink(tmp_path / 'dest' / 'link') == 'real'
+    assert os.readlink(tmp_path / 'dest' / 'dangling') == 'missing'
+    assert (tmp_path / 'dest' / 'link').read_text() == 'data'
+
+
+def test_sync_does_not_follow_a_symlink_it_deletes(tmp_path):
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'outside').mkdir()
+    (tmp_path / 'outside' / 'file').write_text('keep me')
+    (tmp_path / 'dest').mkdir()
+    (tmp_path / 'dest' / 'link').symlink_to(tmp_path / 'outside')
+    sync(tmp_path / 'src', tmp_path / 'dest')
+    assert os.listdir(tmp_path / 'dest') == []
+    assert (tmp_path / 'outside' / 'file').read_text() == 'keep me'
+
+
+def test_sync_replaces_a_file_with_a_directory(tmp_path):
+    (tmp_path / 'src' / 'conf').mkdir(parents=True)
+    (tmp_path / 'src' / 'conf' / 'app.ini').write_text('port=80')
+    (tmp_path / 'dest').mkdir()
+    (tmp_path / 'dest' / 'conf').write_text('was a file')
+    sync(tmp_path / 'src', tmp_path / 'dest')
+    assert (tmp_path / 'dest' / 'conf').is_dir()
+    assert (tmp_path / 'dest' / 'conf' / 'app.ini').read_text() == 'port=80'
+
+
+def test_sync_replaces_a_directory_with_a_file(tmp_path):
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'src' / 'conf').write_text('now a file')
+    (tmp_path / 'dest' / 'conf').mkdir(parents=True)
+    (tmp_path / 'dest' / 'conf' / 'app.ini').write_text('port=80')
+    sync(tmp_path / 'src', tmp_path / 'dest')
+    assert (tmp_path / 'dest' / 'conf').read_text() == 'now a file'